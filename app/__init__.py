@@ -22,6 +22,8 @@ login_manager.login_view = 'auth.login'
 
 def create_app(config_name):
     app = Flask(__name__)
+    from .photos import PhotoUploadRequest
+    app.request_class = PhotoUploadRequest
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
 
@@ -5,7 +5,7 @@ from wtforms import StringField, PasswordField, BooleanField, SubmitField, \
 from wtforms.validators import Required, Length, Email, Regexp, EqualTo
 from wtforms import ValidationError
 from wtforms.ext.appengine.db import model_form
-from ..models import User, Role
+from ..models import User, role_table
 
 
 class UserForm(Form):
@@ -25,8 +25,7 @@ class UserForm(Form):
 
     def __init__(self, *args, **kwargs):
         super(UserForm, self).__init__(*args, **kwargs)
-        self.role.choices = [(role.id, role.name)
-                             for role in Role.query.order_by(Role.name).all()]
+        self.role.choices = role_table().choices
 
 class CreateUserForm(UserForm):
     password = PasswordField('Password',
@@ -4,7 +4,9 @@ from flask.ext.login import login_user, logout_user, login_required, \
     current_user
 from . import admin
 from .. import db
-from ..models import Role, User, Permission
+from ..cache import cache_stats
+from ..models import Role, User, Permission, role_table
+from ..pagination import paginate, estimated_count
 from .forms import CreateUserForm, EditUserForm
 
 @admin.before_request
@@ -18,18 +20,18 @@ def admin_only():
 
 @admin.route('/')
 def index():
-    return render_template('admin/index.html')
+    return render_template('admin/index.html', caches=cache_stats())
 
 @admin.route('/users', methods=['GET', 'POST'])
 def users():
     '''
     Manage users - list users
     '''
-    form = CreateUserForm(role=Role.query.filter_by(name='User').first().id)
+    form = CreateUserForm(role=role_table().default.id)
     if form.validate_on_submit():
         user = User(email=form.email.data,
                     username=form.username.data,
-                    role=Role.query.get(form.role.data),
+                    role=Role.get_cached(form.role.data),
                     password=form.password.data,
                     confirmed=form.confirmed.data,
                     name=form.name.data,
@@ -41,9 +43,9 @@ def users():
         return redirect(url_for('.users'))
 
     page = request.args.get('page', 1, type=int)
-    pagination = User.query.order_by(User.id).paginate(
-        page, per_page=current_app.config['ADMIN_ITEMS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(User.query.order_by(User.id), page,
+                          current_app.config['ADMIN_ITEMS_PER_PAGE'],
+                          total=lambda: estimated_count(User))
     users = pagination.items
     return render_template('admin/users.html', form=form,
                            users=users, pagination=pagination)
@@ -58,7 +60,7 @@ def user(id):
     if form.validate_on_submit():
         user.email = form.email.data
         user.username = form.username.data
-        user.role = Role.query.get(form.role.data)
+        user.role = Role.get_cached(form.role.data)
         user.confirmed = form.confirmed.data
         user.name = form.name.data
         user.location = form.location.data
@@ -1,10 +1,53 @@
-from flask import g, jsonify
+import hashlib
+import hmac
+import threading
+import six
+from flask import g, current_app
 from flask.ext.httpauth import HTTPBasicAuth
+from werkzeug.security import check_password_hash
+from ..cache import get_cache
 from ..models import User, AnonymousUser
 from . import api
 from .errors import unauthorized, forbidden
+from .responses import api_response
 
 auth = HTTPBasicAuth()
+_semaphore_lock = threading.Lock()
+
+
+def _bytes(value):
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def credentials_key(email, password):
+    '''
+    Keyed digest of a pair of credentials, cheap to compute and useless
+    without the secret key of the application
+    '''
+    return hmac.new(_bytes(current_app.config['SECRET_KEY']),
+                    _bytes(email) + b'\0' + _bytes(password),
+                    hashlib.sha256).digest()
+
+
+def check_password(user, password):
+    '''
+    Verify password against the hash of user in the request thread, once
+    one of the APP_PASSWORD_HASH_WORKERS slots of the application is free.
+    This only bounds the number of the deliberately slow hash checks that
+    run at once, the request waits for its own check either way.
+    '''
+    semaphore = current_app.extensions.get('password_semaphore')
+    if semaphore is None:
+        with _semaphore_lock:
+            semaphore = current_app.extensions.get('password_semaphore')
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(
+                    current_app.config['APP_PASSWORD_HASH_WORKERS'])
+                current_app.extensions['password_semaphore'] = semaphore
+    with semaphore:
+        return check_password_hash(user.password_hash, password)
 
 
 @auth.verify_password
@@ -16,12 +59,26 @@ def verify_password(email_or_token, password):
         g.current_user = User.verify_auth_token(email_or_token)
         g.token_used = True
         return g.current_user is not None
+    g.token_used = False
+    # credentials verified recently are trusted while the user keeps the
+    # same email and password hash
+    key = credentials_key(email_or_token, password)
+    credentials = get_cache('credentials')
+    verified = credentials.get(key)
+    if verified is not None:
+        user = User.get_cached(verified[0])
+        if user is not None and \
+                (user.email, user.password_hash) == verified[1:]:
+            g.current_user = user
+            return True
     user = User.query.filter_by(email=email_or_token).first()
     if not user:
         return False
     g.current_user = user
-    g.token_used = False
-    return user.verify_password(password)
+    if not check_password(user, password):
+        return False
+    credentials.set(key, (user.id, user.email, user.password_hash))
+    return True
 
 
 @auth.error_handler
@@ -37,9 +94,24 @@ def before_request():
         return forbidden('Unconfirmed account')
 
 
+@api.after_request
+def issue_token(response):
+    '''
+    Hand a token to clients that authenticate with their password, so
+    that they can use it for their next requests
+    '''
+    if g.get('token_used') is False and response.status_code < 400:
+        expiration = current_app.config['APP_AUTH_TOKEN_EXPIRATION']
+        response.headers['X-Auth-Token'] = \
+            g.current_user.generate_auth_token(expiration=expiration)
+        response.headers['X-Auth-Token-Expiration'] = str(expiration)
+    return response
+
+
 @api.route('/token')
 def get_token():
     if g.current_user.is_anonymous() or g.token_used:
         return unauthorized('Invalid credentials')
-    return jsonify({'token': g.current_user.generate_auth_token(
-        expiration=3600), 'expiration': 3600})
+    expiration = current_app.config['APP_AUTH_TOKEN_EXPIRATION']
+    return api_response({'token': g.current_user.generate_auth_token(
+        expiration=expiration), 'expiration': expiration})
@@ -0,0 +1,92 @@
+import six
+from flask import current_app, json, request, abort
+from ..exceptions import ValidationError
+from ..models import Post, User, Comment
+from . import api
+from .responses import api_response, JSON_MIMETYPE, BATCH_ENVIRON_KEY
+
+# Endpoints whose id argument is the primary key of a model they look up
+_lookups = {
+    'api.get_post': Post,
+    'api.get_post_comments': Post,
+    'api.get_user': User,
+    'api.get_user_posts': User,
+    'api.get_user_followed_posts': User,
+    'api.get_comment': Comment
+}
+
+
+def _relative(url):
+    '''
+    Path of url relative to the host, the absolute URLs found in API
+    resources are accepted too
+    '''
+    if not isinstance(url, six.string_types):
+        raise ValidationError('batch requests must be URLs')
+    root = request.url_root
+    if url.startswith(root):
+        url = url[len(root) - 1:]
+    if not url.startswith('/'):
+        raise ValidationError('batch request %s is not on this server' % url)
+    return url
+
+
+def _prefetch(contexts):
+    '''
+    Load the objects all sub-requests look up by primary key with one
+    query per model. The caller keeps the returned list alive so that the
+    lookups of the views find them in the session identity map.
+    '''
+    ids = {}
+    for ctx in contexts:
+        rule = ctx.request.url_rule
+        if rule is not None and rule.endpoint in _lookups:
+            ids.setdefault(_lookups[rule.endpoint], set()).add(
+                ctx.request.view_args['id'])
+    return [model.query.filter(model.id.in_(model_ids)).all()
+            for model, model_ids in ids.items()]
+
+
+def _dispatch(ctx):
+    '''
+    Run the view of a sub-request, without the authentication and other
+    before_request handlers that already ran for the batch
+    '''
+    with ctx:
+        try:
+            if ctx.request.routing_exception is not None:
+                raise ctx.request.routing_exception
+            endpoint = ctx.request.url_rule.endpoint
+            if not endpoint.startswith(api.name + '.') or \
+                    endpoint == 'api.batch':
+                abort(404)
+            rv = current_app.view_functions[endpoint](
+                **ctx.request.view_args)
+        except Exception as e:
+            rv = current_app.handle_user_exception(e)
+        response = current_app.make_response(rv)
+        payload = getattr(response, 'payload', None)
+        if payload is None and response.mimetype == JSON_MIMETYPE:
+            payload = json.loads(response.get_data(as_text=True))
+        return {'status': response.status_code, 'body': payload}
+
+
+@api.route('/batch', methods=['POST'])
+def batch():
+    urls = (request.json or {}).get('requests')
+    if not isinstance(urls, list):
+        raise ValidationError('batch does not have a list of requests')
+    if len(urls) > current_app.config['APP_BATCH_MAX_REQUESTS']:
+        raise ValidationError('batch has too many requests')
+    paths = [_relative(url) for url in urls]
+    # identical sub-requests are only dispatched once
+    contexts = dict((path, current_app.test_request_context(
+        path, base_url=request.url_root,
+        headers={'Accept': JSON_MIMETYPE},
+        environ_overrides={BATCH_ENVIRON_KEY: True}))
+        for path in set(paths))
+    loaded = _prefetch(contexts.values())
+    results = dict((path, _dispatch(ctx)) for path, ctx in contexts.items())
+    del loaded
+    return api_response({'responses': [
+        dict(results[path], url=url) for path, url in zip(paths, urls)]})
@@ -1,57 +1,39 @@
-from flask import jsonify, request, g, url_for, current_app
+from flask import request, g, url_for, current_app
 from .. import db
 from ..models import Post, Permission, Comment
+from ..pagination import paginate_collection
+from ..serializers import to_json, to_json_list
 from . import api
 from .decorators import permission_required
+from .responses import api_response
 
 
 @api.route('/comments/')
 def get_comments():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-        error_out=False)
-    comments = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_comments', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_comments', page=page+1, _external=True)
-    return jsonify({
-        'posts': [comment.to_json() for comment in comments],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+    comments, pagination = paginate_collection(
+        Comment.query, 'api.get_comments',
+        current_app.config['APP_COMMENTS_PER_PAGE'],
+        Comment.timestamp.desc(), (Comment.timestamp, Comment.id))
+    return api_response(dict(
+        pagination, posts=to_json_list(comments, ('author',))))
 
 
 @api.route('/comments/<int:id>')
 def get_comment(id):
     comment = Comment.query.get_or_404(id)
-    return jsonify(comment.to_json())
+    return api_response(to_json(comment, ('author',)))
 
 
 @api.route('/posts/<int:id>/comments/')
 def get_post_comments(id):
     post = Post.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-        error_out=False)
-    comments = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_comments', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_comments', page=page+1, _external=True)
-    return jsonify({
-        'posts': [comment.to_json() for comment in comments],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+    comments, pagination = paginate_collection(
+        post.comments, 'api.get_post_comments',
+        current_app.config['APP_COMMENTS_PER_PAGE'],
+        Comment.timestamp.asc(), (Comment.timestamp, Comment.id),
+        ascending=True, id=id)
+    return api_response(dict(
+        pagination, posts=to_json_list(comments, ('author',))))
 
 
 @api.route('/posts/<int:id>/comments/', methods=['POST'])
@@ -63,6 +45,6 @@ def new_post_comment(id):
     comment.post = post
     db.session.add(comment)
     db.session.commit()
-    return jsonify(comment.to_json()), 201, \
+    return api_response(comment.to_json()), 201, \
         {'Location': url_for('api.get_comment', id=comment.id,
                              _external=True)}
@@ -1,22 +1,22 @@
-from flask import jsonify
 from app.exceptions import ValidationError
 from . import api
+from .responses import api_response
 
 
 def bad_request(message):
-    response = jsonify({'error': 'bad request', 'message': message})
+    response = api_response({'error': 'bad request', 'message': message})
     response.status_code = 400
     return response
 
 
 def unauthorized(message):
-    response = jsonify({'error': 'unauthorized', 'message': message})
+    response = api_response({'error': 'unauthorized', 'message': message})
     response.status_code = 401
     return response
 
 
 def forbidden(message):
-    response = jsonify({'error': 'forbidden', 'message': message})
+    response = api_response({'error': 'forbidden', 'message': message})
     response.status_code = 403
     return response
 
@@ -1,35 +1,27 @@
-from flask import jsonify, request, g, abort, url_for, current_app, send_from_directory
+from flask import request, g, abort, url_for, current_app, send_from_directory
 from sqlalchemy import desc
 from .. import db
 from ..models import Post, Permission
+from ..pagination import paginate_collection
+from ..serializers import to_json, to_json_list
 from . import api
 from .decorators import permission_required
 from .errors import forbidden
+from .responses import api_response
 
 @api.route('/posts/')
 def get_posts():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(desc(Post.id)).paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False)
-    posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_posts', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_posts', page=page+1, _external=True)
-    return jsonify({
-        'posts': [post.to_json() for post in posts],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+    posts, pagination = paginate_collection(
+        Post.query, 'api.get_posts',
+        current_app.config['APP_POSTS_PER_PAGE'], desc(Post.id),
+        (Post.timestamp, Post.id))
+    return api_response(dict(
+        pagination, posts=to_json_list(posts, ('author',))))
 
 @api.route('/posts/<int:id>')
 def get_post(id):
     post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    return api_response(to_json(post, ('author',)))
 
 # @api.route('/post-img/<int:id>')
 # def get_post_img(id):
@@ -44,7 +36,7 @@ def new_post():
     post.author = g.current_user
     db.session.add(post)
     db.session.commit()
-    return jsonify(post.to_json()), 201, \
+    return api_response(post.to_json()), 201, \
         {'Location': url_for('api.get_post', id=post.id, _external=True)}
 
 
@@ -57,4 +49,4 @@ def edit_post(id):
         return forbidden('Insufficient permissions')
     post.body = request.json.get('body', post.body)
     db.session.add(post)
-    return jsonify(post.to_json())
+    return api_response(post.to_json())
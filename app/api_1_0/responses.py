@@ -0,0 +1,71 @@
+from datetime import datetime
+from flask import current_app, json, request
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+BATCH_ENVIRON_KEY = 'app.batch'
+
+
+def _default(o):
+    '''
+    Encode the types the API returns beyond the basic ones, the same way
+    Flask's JSON encoder does
+    '''
+    if isinstance(o, datetime):
+        return http_date(o)
+    raise TypeError('%r is not serializable' % o)
+
+
+def dumps_json(data):
+    '''
+    Compact JSON, encoded with orjson when it is installed
+    '''
+    if orjson is not None:
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if current_app.config['JSON_SORT_KEYS']:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(data, default=_default, option=option)
+    return json.dumps(data, separators=(',', ':'))
+
+
+def dumps_msgpack(data):
+    return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+def api_response(data, status=200, headers=None):
+    '''
+    Build an API response in the format the client accepts: MessagePack
+    when it asks for application/msgpack and msgpack is installed,
+    compact JSON otherwise.
+
+    The data is also kept on the response as ``payload``. Sub-requests
+    of a batch are not encoded at all, the batch response embeds their
+    payload instead.
+    '''
+    mimetype = JSON_MIMETYPE
+    if request.environ.get(BATCH_ENVIRON_KEY):
+        body = b''
+    else:
+        if msgpack is not None:
+            mimetype = request.accept_mimetypes.best_match(
+                [JSON_MIMETYPE, MSGPACK_MIMETYPE], default=JSON_MIMETYPE)
+        if mimetype == MSGPACK_MIMETYPE:
+            body = dumps_msgpack(data)
+        else:
+            body = dumps_json(data)
+    response = current_app.response_class(body, status=status,
+                                          headers=headers, mimetype=mimetype)
+    response.vary.add('Accept')
+    response.payload = data
+    return response
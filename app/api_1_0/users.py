@@ -1,53 +1,34 @@
-from flask import jsonify, request, current_app, url_for
+from flask import current_app
 from . import api
 from ..models import User, Post
+from ..pagination import paginate_collection
+from ..serializers import to_json, to_json_list
+from .responses import api_response
 
 
 @api.route('/users/<int:id>')
 def get_user(id):
     user = User.query.get_or_404(id)
-    return jsonify(user.to_json())
+    return api_response(to_json(user))
 
 
 @api.route('/users/<int:id>/posts/')
 def get_user_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False)
-    posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_posts', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_posts', page=page+1, _external=True)
-    return jsonify({
-        'posts': [post.to_json() for post in posts],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+    posts, pagination = paginate_collection(
+        user.posts, 'api.get_user_posts',
+        current_app.config['APP_POSTS_PER_PAGE'], Post.timestamp.desc(),
+        (Post.timestamp, Post.id), id=id)
+    return api_response(dict(
+        pagination, posts=to_json_list(posts, ('author',))))
 
 
 @api.route('/users/<int:id>/timeline/')
 def get_user_followed_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False)
-    posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_posts', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_posts', page=page+1, _external=True)
-    return jsonify({
-        'posts': [post.to_json() for post in posts],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
-    })
+    posts, pagination = paginate_collection(
+        user.followed_posts, 'api.get_user_followed_posts',
+        current_app.config['APP_POSTS_PER_PAGE'], Post.timestamp.desc(),
+        (Post.timestamp, Post.id), id=id)
+    return api_response(dict(
+        pagination, posts=to_json_list(posts, ('author',))))
@@ -4,7 +4,8 @@ from flask.ext.login import login_user, logout_user, login_required, \
 from . import auth
 from .. import db
 from ..models import User
-from ..email import send_email
+from ..email import queue_email
+from ..presence import presence_tracker
 from .forms import LoginForm, RegistrationForm, ChangePasswordForm,\
     PasswordResetRequestForm, PasswordResetForm, ChangeEmailForm
 
@@ -12,7 +13,7 @@ from .forms import LoginForm, RegistrationForm, ChangePasswordForm,\
 @auth.before_app_request
 def before_request():
     if current_user.is_authenticated():
-        current_user.ping()
+        presence_tracker().seen(current_user.id)
         if not current_user.confirmed \
                 and request.endpoint[:5] != 'auth.' \
                 and request.endpoint != 'static':
@@ -54,10 +55,11 @@ def register():
                     username=form.username.data,
                     password=form.password.data)
         db.session.add(user)
-        db.session.commit()
+        db.session.flush()
         token = user.generate_confirmation_token()
-        send_email(user.email, 'Confirm Your Account',
-                   'auth/email/confirm', user=user, token=token)
+        queue_email(user.email, 'Confirm Your Account',
+                    'auth/email/confirm', user=user, token=token)
+        db.session.commit()
         flash('A confirmation email has been sent to you by email.', 'info')
         return redirect(url_for('auth.login'))
     return render_template('auth/register.html', form=form)
@@ -79,8 +81,9 @@ def confirm(token):
 @login_required
 def resend_confirmation():
     token = current_user.generate_confirmation_token()
-    send_email(current_user.email, 'Confirm Your Account',
-               'auth/email/confirm', user=current_user, token=token)
+    queue_email(current_user.email, 'Confirm Your Account',
+                'auth/email/confirm', user=current_user, token=token)
+    db.session.commit()
     flash('A new confirmation email has been sent to you by email.', 'info')
     return redirect(url_for('main.index'))
 
@@ -109,10 +112,11 @@ def password_reset_request():
         user = User.query.filter_by(email=form.email.data).first()
         if user:
             token = user.generate_reset_token()
-            send_email(user.email, 'Reset Your Password',
-                       'auth/email/reset_password',
-                       user=user, token=token,
-                       next=request.args.get('next'))
+            queue_email(user.email, 'Reset Your Password',
+                        'auth/email/reset_password',
+                        user=user, token=token,
+                        next=request.args.get('next'))
+            db.session.commit()
         flash('An email with instructions to reset your password has been '
               'sent to you.', 'info')
         return redirect(url_for('auth.login'))
@@ -144,9 +148,10 @@ def change_email_request():
         if current_user.verify_password(form.password.data):
             new_email = form.email.data
             token = current_user.generate_email_change_token(new_email)
-            send_email(new_email, 'Confirm your email address',
-                       'auth/email/change_email',
-                       user=current_user, token=token)
+            queue_email(new_email, 'Confirm your email address',
+                        'auth/email/change_email',
+                        user=current_user, token=token)
+            db.session.commit()
             flash('An email with instructions to confirm your new email '
                   'address has been sent to you.', 'info')
             return redirect(url_for('main.index'))
@@ -0,0 +1,73 @@
+import math
+
+_characters = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ' \
+    'abcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def _base83(value, length):
+    return ''.join(_characters[value // 83 ** (length - i - 1) % 83]
+                   for i in range(length))
+
+
+def _linear(value):
+    value = value / 255.0
+    if value <= 0.04045:
+        return value / 12.92
+    return ((value + 0.055) / 1.055) ** 2.4
+
+
+def _srgb(value):
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _quantize(value, maximum):
+    value = math.copysign(abs(value / maximum) ** 0.5, value)
+    return max(0, min(18, int(math.floor(value * 9 + 9.5))))
+
+
+def encode(image, x_components=4, y_components=3):
+    '''
+    BlurHash of a PIL image, a short string that clients decode into a
+    blurred placeholder. The cost grows with the number of pixels, so
+    the image should be scaled down to a few dozen pixels first.
+    '''
+    image = image.convert('RGB')
+    width, height = image.size
+    pixels = [tuple(_linear(c) for c in pixel) for pixel in image.getdata()]
+    factors = []
+    for j in range(y_components):
+        rows = [math.cos(math.pi * j * y / height) for y in range(height)]
+        for i in range(x_components):
+            columns = [math.cos(math.pi * i * x / width)
+                       for x in range(width)]
+            factor = [0.0, 0.0, 0.0]
+            for y, row in enumerate(rows):
+                offset = y * width
+                for x, column in enumerate(columns):
+                    basis = row * column
+                    pixel = pixels[offset + x]
+                    factor[0] += basis * pixel[0]
+                    factor[1] += basis * pixel[1]
+                    factor[2] += basis * pixel[2]
+            scale = (1.0 if i == j == 0 else 2.0) / (width * height)
+            factors.append([value * scale for value in factor])
+
+    dc, ac = factors[0], factors[1:]
+    blurhash = _base83(x_components - 1 + (y_components - 1) * 9, 1)
+    maximum = 1.0
+    if ac:
+        largest = max(abs(value) for factor in ac for value in factor)
+        quantized = max(0, min(82, int(math.floor(largest * 166 - 0.5))))
+        maximum = (quantized + 1) / 166.0
+        blurhash += _base83(quantized, 1)
+    else:
+        blurhash += _base83(0, 1)
+    blurhash += _base83((_srgb(dc[0]) << 16) + (_srgb(dc[1]) << 8) +
+                        _srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = [_quantize(value, maximum) for value in factor]
+        blurhash += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return blurhash
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+
+
+class LRUCache(object):
+    '''
+    Thread safe mapping that keeps at most maxsize entries, each for at
+    most ttl seconds, evicting the least recently used ones first. Hits
+    and misses are counted to help sizing it.
+    '''
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else None
+        }
+
+
+def get_cache(name):
+    '''
+    The cache called name of the current application, created on first
+    use from the APP_<NAME>_CACHE_SIZE and APP_<NAME>_CACHE_TTL settings.
+    Caches live in the memory of each process.
+    '''
+    caches = current_app.extensions.setdefault('caches', {})
+    cache = caches.get(name)
+    if cache is None:
+        prefix = 'APP_%s_CACHE_' % name.upper()
+        cache = caches.setdefault(name, LRUCache(
+            current_app.config[prefix + 'SIZE'],
+            current_app.config[prefix + 'TTL']))
+    return cache
+
+
+def invalidate(name, key=None):
+    '''
+    Drop key, or every entry when key is None, from the cache called name
+    of the current application, if there is one
+    '''
+    if not has_app_context():
+        return
+    cache = current_app.extensions.get('caches', {}).get(name)
+    if cache is None:
+        return
+    if key is None:
+        cache.clear()
+    else:
+        cache.delete(key)
+
+
+def cache_stats():
+    '''
+    Statistics of all the caches of the current application, by name
+    '''
+    caches = current_app.extensions.get('caches', {})
+    return dict((name, cache.stats) for name, cache in caches.items())
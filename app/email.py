@@ -1,20 +1,106 @@
-from threading import Thread
-from flask import current_app, render_template
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app, render_template, json
 from flask.ext.mail import Message
-from . import mail
+from . import db, mail
+from .models import OutboxEmail, User
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-
-
-def send_email(to, subject, template, **kwargs):
+def make_message(to, subject, template, **kwargs):
     app = current_app._get_current_object()
     msg = Message(app.config['APP_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
                   sender=app.config['APP_MAIL_SENDER'], recipients=[to])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    return msg
+
+
+def queue_email(to, subject, template, user=None, **kwargs):
+    '''
+    Add an email to the outbox in the current transaction, so that it is
+    only sent if the transaction commits. The templates are rendered by
+    dispatch_outbox, with the user and the JSON serializable kwargs.
+    '''
+    email = OutboxEmail(recipient=to, subject=subject, template=template,
+                        user=user, context=json.dumps(kwargs))
+    db.session.add(email)
+    return email
+
+
+def _retry_delay(attempts):
+    delay = current_app.config['APP_MAIL_RETRY_DELAY'] * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, 24 * 3600))
+
+
+def _claim(now, batch_size):
+    '''
+    Lease a batch of due emails to this dispatcher, so that concurrent
+    dispatchers do not send them again unless the lease expires. The
+    leased rows are found again by a random claim, as databases may not
+    keep the microseconds of the lease.
+    '''
+    ids = [id for id, in db.session.query(OutboxEmail.id)
+           .filter(OutboxEmail.next_attempt_at <= now)
+           .order_by(OutboxEmail.next_attempt_at).limit(batch_size)]
+    if not ids:
+        return []
+    lease = now + timedelta(seconds=current_app.config['APP_MAIL_LEASE'])
+    claim = uuid.uuid4().hex
+    OutboxEmail.query.filter(OutboxEmail.id.in_(ids),
+                             OutboxEmail.next_attempt_at <= now)\
+        .update({'next_attempt_at': lease, 'claim': claim},
+                synchronize_session=False)
+    db.session.commit()
+    return OutboxEmail.query.filter(OutboxEmail.id.in_(ids),
+                                    OutboxEmail.claim == claim)\
+        .order_by(OutboxEmail.id).all()
+
+
+def dispatch_outbox(batch_size=100):
+    '''
+    Render and send the due emails of the outbox, batch_size at a time
+    over one SMTP connection per batch, until none is due. Failures are
+    retried after APP_MAIL_RETRY_DELAY seconds, doubled at each attempt,
+    up to APP_MAIL_MAX_ATTEMPTS attempts. Returns the number of emails
+    sent and failed.
+    '''
+    sent = failed = 0
+    while True:
+        now = datetime.utcnow()
+        emails = _claim(now, batch_size)
+        if not emails:
+            return sent, failed
+        # load the users of the batch at once, email.user finds them in
+        # the identity map
+        users = User.query.filter(User.id.in_(
+            set(email.user_id for email in emails))).all()
+        try:
+            with current_app.test_request_context(
+                    base_url=current_app.config['APP_BASE_URL']), \
+                    mail.connect() as connection:
+                for email in emails:
+                    try:
+                        connection.send(make_message(
+                            email.recipient, email.subject, email.template,
+                            user=email.user, **json.loads(email.context)))
+                    except Exception as e:
+                        email.last_error = repr(e)
+                    else:
+                        email.sent_at = now
+                        email.next_attempt_at = None
+        except Exception as e:
+            current_app.logger.exception('Email dispatch failed')
+            for email in emails:
+                if email.sent_at is None:
+                    email.last_error = repr(e)
+        for email in emails:
+            if email.sent_at is not None:
+                sent += 1
+                continue
+            failed += 1
+            email.attempts += 1
+            if email.attempts >= current_app.config['APP_MAIL_MAX_ATTEMPTS']:
+                email.next_attempt_at = None
+            else:
+                email.next_attempt_at = now + _retry_delay(email.attempts)
+        db.session.commit()
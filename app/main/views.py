@@ -1,17 +1,18 @@
-import hashlib
-import os
-import time
 from flask import render_template, redirect, url_for, abort, flash, request,\
-    current_app, make_response, send_from_directory
+    current_app, make_response
 from flask.ext.login import login_required, current_user
 from flask.ext.sqlalchemy import get_debug_queries
-from werkzeug import secure_filename
 from . import main
 from .forms import EditProfileForm, EditProfileAdminForm, PostForm,\
     CommentForm
 from .. import db
 from ..models import Permission, Role, User, Post, Comment
 from ..decorators import admin_required, permission_required
+from ..pagination import paginate, estimated_count
+from ..photos import save_photo, generate_thumbnails, extract_metadata, \
+    hash_upload, find_duplicate, deletion_queue, sized_photo, \
+    transcoded_photo, photo_etag, storage_path
+from ..storage import get_storage
 
 
 @main.after_app_request
@@ -39,10 +40,22 @@ def server_shutdown():
 @main.route('/photos/<filename>')
 def uploaded_photos(filename):
     '''
-    Serve user-uploaded photos
+    Serve user-uploaded photos, or their thumbnails for ?size=<pixels>,
+    in the most compact format the client accepts. Photos of remote
+    storages are redirected to.
     '''
-    return send_from_directory(current_app.config['UPLOADS_DIR'],
-                               filename)
+    size = request.args.get('size', type=int)
+    sized = sized_photo(filename, size)
+    # the photo stands in for a thumbnail that is not made yet, which
+    # clients should not keep for good
+    max_age = None
+    if size is not None and sized == filename:
+        max_age = current_app.config['APP_PHOTO_FALLBACK_MAX_AGE']
+    served = transcoded_photo(sized, request.accept_mimetypes)
+    response = get_storage().send(storage_path(served), photo_etag,
+                                  max_age)
+    response.vary.add('Accept')
+    return response
 
 @main.route('/', methods=['GET', 'POST'])
 def index():
@@ -53,21 +66,42 @@ def index():
         # Save uploaded photo
         try:
             photofile = form.photo.data
-            hash = hashlib.sha1(str(time.time()) + \
-                                secure_filename(photofile.filename))
-            file_ext = os.path.splitext(photofile.filename)[1]
-            filename = hash.hexdigest()[:16] + file_ext
-            photofile.save(os.path.join(current_app.config['UPLOADS_DIR'],
-                                        filename))
+            filename = save_photo(photofile.stream, photofile.filename)
         except:
             flash('Unable to upload photo', 'warning')
             return redirect(url_for('.index'))
-            
+
+        # Posts of photos the author posted before, resized or
+        # recompressed, use the stored copy. Photos that only look like
+        # one are posted, with a warning.
+        author = current_user._get_current_object()
+        columns = hash_upload(filename)
+        duplicate = columns and find_duplicate(filename, columns, author)
+        reused = False
+        if duplicate:
+            earlier, reused = duplicate
+            if reused:
+                deletion_queue().schedule([filename])
+                filename = earlier.imagefile
+                columns = earlier.photo_metadata()
+                flash('You posted this photo before, its stored copy is '
+                      'used.', 'info')
+            else:
+                flash('This photo looks like the one you posted on %s.' %
+                      earlier.timestamp.strftime('%Y-%m-%d'), 'warning')
+
         post = Post(body=form.body.data,
                     imagefile=filename,
-                    author=current_user._get_current_object())
+                    author=author,
+                    **(columns or {}))
         db.session.add(post)
-            
+        # the photo is processed in the background, and the rest of its
+        # metadata written to the committed post
+        db.session.commit()
+        if not reused:
+            generate_thumbnails(filename)
+            extract_metadata(filename)
+
         flash('Your post has successfully been saved.', 'success')
         return redirect(url_for('.index'))
 
@@ -81,9 +115,13 @@ def index():
         query = current_user.followed_posts
     else:
         query = Post.query
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False)
+    query = query.options(db.joinedload('author'))
+    total = None
+    if not show_followed:
+        total = lambda: estimated_count(Post)
+    pagination = paginate(query.order_by(Post.timestamp.desc()), page,
+                          current_app.config['APP_POSTS_PER_PAGE'],
+                          total=total)
     posts = pagination.items
     return render_template('index.html', form=form, posts=posts,
                            show_followed=show_followed, pagination=pagination)
@@ -93,9 +131,9 @@ def index():
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(user.posts.order_by(Post.timestamp.desc()), page,
+                          current_app.config['APP_POSTS_PER_PAGE'],
+                          total=user.post_count)
     posts = pagination.items
     return render_template('user.html', user=user, posts=posts,
                            pagination=pagination)
@@ -128,7 +166,7 @@ def edit_profile_admin(id):
         user.email = form.email.data
         user.username = form.username.data
         user.confirmed = form.confirmed.data
-        user.role = Role.query.get(form.role.data)
+        user.role = Role.get_cached(form.role.data)
         user.name = form.name.data
         user.location = form.location.data
         user.about_me = form.about_me.data
@@ -147,7 +185,7 @@ def edit_profile_admin(id):
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
 def post(id):
-    post = Post.query.get_or_404(id)
+    post = Post.query.options(db.joinedload('author')).get_or_404(id)
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data,
@@ -158,11 +196,13 @@ def post(id):
         return redirect(url_for('.post', id=post.id, page=-1))
     page = request.args.get('page', 1, type=int)
     if page == -1:
-        page = (post.comments.count() - 1) / \
+        page = (post.comment_count - 1) / \
             current_app.config['APP_COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-        error_out=False)
+    query = post.comments.options(db.joinedload('author'))\
+        .order_by(Comment.timestamp.asc())
+    pagination = paginate(query, page,
+                          current_app.config['APP_COMMENTS_PER_PAGE'],
+                          total=post.comment_count)
     comments = pagination.items
     return render_template('post.html', posts=[post], form=form,
                            comments=comments, pagination=pagination)
@@ -224,9 +264,9 @@ def followers(username):
         flash('Invalid user.', 'danger')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type=int)
-    pagination = user.followers.paginate(
-        page, per_page=current_app.config['APP_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(user.followers, page,
+                          current_app.config['APP_FOLLOWERS_PER_PAGE'],
+                          total=user.follower_count)
     follows = [{'user': item.follower, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followers.html', user=user, title="Followers of",
@@ -241,9 +281,9 @@ def followed_by(username):
         flash('Invalid user.', 'danger')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type=int)
-    pagination = user.followed.paginate(
-        page, per_page=current_app.config['APP_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(user.followed, page,
+                          current_app.config['APP_FOLLOWERS_PER_PAGE'],
+                          total=user.followed_count)
     follows = [{'user': item.followed, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followers.html', user=user, title="Followed by",
@@ -272,9 +312,11 @@ def show_followed():
 @permission_required(Permission.MODERATE_COMMENTS)
 def moderate():
     page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-        error_out=False)
+    query = Comment.query.options(db.joinedload('author'))\
+        .order_by(Comment.timestamp.desc())
+    pagination = paginate(query, page,
+                          current_app.config['APP_COMMENTS_PER_PAGE'],
+                          total=lambda: estimated_count(Comment))
     comments = pagination.items
     return render_template('moderate.html', comments=comments,
                            pagination=pagination, page=page)
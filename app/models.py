@@ -1,13 +1,22 @@
 from datetime import datetime
 import hashlib
+import time
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from markdown import markdown
 import bleach
-from flask import current_app, request, url_for
+from sqlalchemy import select, func, literal
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from flask import current_app, request, has_app_context
 from flask.ext.login import UserMixin, AnonymousUserMixin
+from flask.ext.sqlalchemy import SignallingSession
 from app.exceptions import ValidationError
-from . import db, login_manager
+from . import db, login_manager, similarity
+from .cache import get_cache, invalidate
+from .photos import deletion_queue
+from .serializers import external_url, select_fields
 
 
 class Permission:
@@ -47,19 +56,180 @@ class Role(db.Model):
             db.session.add(role)
         db.session.commit()
 
+    @staticmethod
+    def get_cached(id):
+        '''
+        Return the role with the given id, attached to the session from
+        the role table without a SELECT
+        '''
+        role = role_table().by_id.get(id)
+        if role is None:
+            return None
+        return db.session.merge(role, load=False)
+
+    @staticmethod
+    def on_changed(mapper, connection, target):
+        invalidate('role')
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        # assigning a role to a user also flushes the role
+        if any(get_history(target, attr.key).has_changes()
+               for attr in mapper.column_attrs):
+            invalidate('role')
+
     def __repr__(self):
         #return '<Role %r>' % self.name
         return self.name
 
 
+db.event.listen(Role, 'after_insert', Role.on_changed)
+db.event.listen(Role, 'after_update', Role.on_updated)
+db.event.listen(Role, 'after_delete', Role.on_changed)
+
+
+class RoleTable(object):
+    '''
+    Immutable snapshot of the roles table, shared by the threads of a
+    process. The roles are detached copies: use Role.get_cached to get
+    one that can be assigned to a user.
+    '''
+    def __init__(self, roles):
+        self.roles = tuple(sorted((detached_copy(role) for role in roles),
+                                  key=lambda role: role.name))
+        self.by_id = dict((role.id, role) for role in self.roles)
+        self.by_name = dict((role.name, role) for role in self.roles)
+        self.default = next((role for role in self.roles if role.default),
+                            None)
+        self.administrator = next((role for role in self.roles
+                                   if role.permissions == 0xff), None)
+        self.choices = [(role.id, role.name) for role in self.roles]
+
+
+def role_table():
+    '''
+    The role table of the application, loaded on first use and reloaded
+    after roles are changed, or APP_ROLE_CACHE_TTL seconds later for the
+    changes made by other processes
+    '''
+    cache = get_cache('role')
+    table = cache.get('table')
+    if table is None:
+        table = RoleTable(Role.query.all())
+        cache.set('table', table)
+    return table
+
+
+def detached_copy(instance, exclude=()):
+    '''
+    Copy the loaded column attributes of instance into a new detached
+    instance, which can be shared between sessions and attached to one
+    with session.merge(copy, load=False). Excluded attributes are left
+    expired, they are loaded from the database when they are used.
+    '''
+    mapper = db.inspect(instance).mapper
+    copy = mapper.class_manager.new_instance()
+    for attr in mapper.column_attrs:
+        if attr.key not in exclude and attr.key in instance.__dict__:
+            set_committed_value(copy, attr.key, instance.__dict__[attr.key])
+    make_transient_to_detached(copy)
+    return copy
+
+
+def update_counter(connection, column, id, delta):
+    '''
+    Atomically add delta to a denormalized counter column of one row
+    '''
+    table = column.table
+    connection.execute(table.update().where(table.c.id == id)
+                       .values({column.name: column + delta}))
+
+
 class Follow(db.Model):
     __tablename__ = 'follows'
     follower_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                             primary_key=True)
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'),
-                            primary_key=True)
+                            primary_key=True, index=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        '''
+        Backfill the follower's timeline with the most recent posts of
+        the followed user, unless that user is served fan-out-on-read
+        '''
+        users = User.__table__
+        posts = Post.__table__
+        update_counter(connection, users.c.followed_count,
+                       target.follower_id, 1)
+        update_counter(connection, users.c.follower_count,
+                       target.followed_id, 1)
+        if connection.scalar(select([users.c.fanout_on_read])
+                             .where(users.c.id == target.followed_id)):
+            return
+        recent = select([literal(target.follower_id), posts.c.id])\
+            .where(posts.c.author_id == target.followed_id)\
+            .order_by(posts.c.timestamp.desc())\
+            .limit(current_app.config['APP_TIMELINE_BACKFILL'])
+        connection.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id'], recent))
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        '''
+        Prune the followed user's posts from the follower's timeline
+        '''
+        users = User.__table__
+        timelines = Timeline.__table__
+        posts = Post.__table__
+        update_counter(connection, users.c.followed_count,
+                       target.follower_id, -1)
+        update_counter(connection, users.c.follower_count,
+                       target.followed_id, -1)
+        connection.execute(timelines.delete()
+            .where(timelines.c.user_id == target.follower_id)
+            .where(timelines.c.post_id.in_(
+                select([posts.c.id])
+                .where(posts.c.author_id == target.followed_id))))
+
+
+class Timeline(db.Model):
+    '''
+    Materialized home timeline: one row per post delivered to a follower
+    '''
+    __tablename__ = 'timelines'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                        primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'),
+                        primary_key=True)
+
+    @staticmethod
+    def rebuild():
+        '''
+        Recompute the fan-out-on-read flags and refill every timeline
+        from the follows and posts tables
+        '''
+        users = User.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        followers = select([func.count()]).select_from(follows)\
+            .where(follows.c.followed_id == users.c.id).as_scalar()
+        db.session.execute(users.update().values(
+            fanout_on_read=followers >
+            current_app.config['APP_TIMELINE_FANOUT_LIMIT']))
+        db.session.execute(Timeline.__table__.delete())
+        pushed = select([follows.c.follower_id, posts.c.id])\
+            .select_from(follows.join(posts,
+                                      posts.c.author_id ==
+                                      follows.c.followed_id)
+                         .join(users, users.c.id == follows.c.followed_id))\
+            .where(db.or_(users.c.fanout_on_read == None,
+                          users.c.fanout_on_read == False))
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id'], pushed))
+        db.session.commit()
+
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -75,6 +245,11 @@ class User(UserMixin, db.Model):
     member_since = db.Column(db.DateTime(), default=datetime.utcnow)
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
     avatar_hash = db.Column(db.String(32))
+    fanout_on_read = db.Column(db.Boolean, default=False)
+    post_count = db.Column(db.Integer, default=0)
+    comment_count = db.Column(db.Integer, default=0)
+    follower_count = db.Column(db.Integer, default=0)
+    followed_count = db.Column(db.Integer, default=0)
     posts = db.relationship('Post',
                             backref='author',
                             lazy='dynamic',
@@ -91,6 +266,8 @@ class User(UserMixin, db.Model):
                                 cascade='all, delete-orphan')
     comments = db.relationship('Comment', backref='author', lazy='dynamic',
                                cascade='all, delete-orphan')
+    outbox = db.relationship('OutboxEmail', backref='user', lazy='dynamic',
+                             cascade='all, delete-orphan')
 
     @staticmethod
     def generate_fake(count=100):
@@ -116,11 +293,12 @@ class User(UserMixin, db.Model):
 
     @staticmethod
     def create_admin(email, username, password):
+        admin = role_table().administrator
         u = User(email=email,
                  username=username,
                  password=password,
                  confirmed=True,
-                 role=Role.query.filter_by(permissions=0xff).first())
+                 role=admin and Role.get_cached(admin.id))
         db.session.add(u)
         try:
             db.session.commit()
@@ -138,10 +316,12 @@ class User(UserMixin, db.Model):
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
         if self.role is None:
-            if self.email == current_app.config['APP_ADMIN']:
-                self.role = Role.query.filter_by(permissions=0xff).first()
-            if self.role is None:
-                self.role = Role.query.filter_by(default=True).first()
+            roles = role_table()
+            if self.email == current_app.config['APP_ADMIN'] and \
+                    roles.administrator is not None:
+                self.role = Role.get_cached(roles.administrator.id)
+            if self.role is None and roles.default is not None:
+                self.role = Role.get_cached(roles.default.id)
         if self.email is not None and self.avatar_hash is None:
             self.avatar_hash = hashlib.md5(
                 self.email.encode('utf-8')).hexdigest()
@@ -214,8 +394,14 @@ class User(UserMixin, db.Model):
         return True
 
     def can(self, permissions):
-        return self.role is not None and \
-            (self.role.permissions & permissions) == permissions
+        # the role table is only bypassed for a role that was just
+        # assigned and not yet flushed
+        if 'role' in self.__dict__:
+            role = self.role
+        else:
+            role = role_table().by_id.get(self.role_id)
+        return role is not None and \
+            (role.permissions & permissions) == permissions
 
     def is_administrator(self):
         return self.can(Permission.ADMINISTER)
@@ -254,20 +440,37 @@ class User(UserMixin, db.Model):
 
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id)\
-            .filter(Follow.follower_id == self.id)
-
-    def to_json(self):
-        json_user = {
-            'url': url_for('api.get_post', id=self.id, _external=True),
-            'username': self.username,
-            'member_since': self.member_since,
-            'last_seen': self.last_seen,
-            'posts': url_for('api.get_user_posts', id=self.id, _external=True),
-            'followed_posts': url_for('api.get_user_followed_posts',
-                                      id=self.id, _external=True),
-            'post_count': self.posts.count()
-        }
+        '''
+        Posts from followed users, read from the materialized timeline.
+        Posts of users with too many followers are never fanned out, so
+        they are merged in at read time instead.
+        '''
+        pulled = [f.followed_id for f in
+                  db.session.query(Follow.followed_id)
+                  .join(User, User.id == Follow.followed_id)
+                  .filter(Follow.follower_id == self.id)
+                  .filter(User.fanout_on_read == True)]
+        if not pulled:
+            return Post.query.join(Timeline, Timeline.post_id == Post.id)\
+                .filter(Timeline.user_id == self.id)
+        timeline = db.session.query(Timeline.post_id)\
+            .filter(Timeline.user_id == self.id)
+        return Post.query.filter(db.or_(Post.id.in_(timeline),
+                                        Post.author_id.in_(pulled)))
+
+    _json_fields = (
+        ('url', lambda u: external_url('api.get_post', id=u.id)),
+        ('username', lambda u: u.username),
+        ('member_since', lambda u: u.member_since),
+        ('last_seen', lambda u: u.last_seen),
+        ('posts', lambda u: external_url('api.get_user_posts', id=u.id)),
+        ('followed_posts', lambda u: external_url(
+            'api.get_user_followed_posts', id=u.id)),
+        ('post_count', lambda u: u.post_count)
+    )
+
+    def to_json(self, fields=None, expand=()):
+        json_user = select_fields(self, User._json_fields, fields)
         return json_user
 
     def generate_auth_token(self, expiration):
@@ -277,12 +480,55 @@ class User(UserMixin, db.Model):
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return None
-        return User.query.get(data['id'])
+        tokens = get_cache('token')
+        id = tokens.get(token)
+        if id is None:
+            s = Serializer(current_app.config['SECRET_KEY'])
+            try:
+                data, header = s.loads(token, return_header=True)
+            except:
+                return None
+            id = data['id']
+            tokens.set(token, id, ttl=header['exp'] - time.time())
+        return User.get_cached(id)
+
+    # Columns that change without invalidating cached users, they are
+    # left out of the cached copies
+    _volatile_attributes = ('last_seen', 'post_count', 'comment_count',
+                            'follower_count', 'followed_count')
+
+    @staticmethod
+    def get_cached(id):
+        '''
+        Return the user with the given id. Users found in the identity
+        cache are attached to the session without a SELECT.
+        '''
+        identities = get_cache('identity')
+        snapshot = identities.get(id)
+        if snapshot is not None:
+            return db.session.merge(snapshot, load=False)
+        user = User.query.get(id)
+        if user is not None:
+            identities.set(id, detached_copy(user, User._volatile_attributes))
+        return user
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        changed = [attr.key for attr in mapper.column_attrs
+                   if get_history(target, attr.key).has_changes()]
+        if get_history(target, 'role').has_changes() or \
+                set(changed) - set(User._volatile_attributes):
+            invalidate('identity', target.id)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        invalidate('identity', target.id)
+
+    @staticmethod
+    def on_deleting(mapper, connection, target):
+        timelines = Timeline.__table__
+        connection.execute(timelines.delete()
+                           .where(timelines.c.user_id == target.id))
 
     def __repr__(self):
         return '<User %r>' % self.username
@@ -300,7 +546,7 @@ login_manager.anonymous_user = AnonymousUser
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return User.get_cached(int(user_id))
 
 
 class Post(db.Model):
@@ -308,9 +554,23 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
-    imagefile = db.Column(db.String(32), unique=True)
+    imagefile = db.Column(db.String(32), index=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    comment_count = db.Column(db.Integer, default=0)
+    # Filled in by app.photos.extract_metadata once the photo is analyzed
+    photo_width = db.Column(db.Integer)
+    photo_height = db.Column(db.Integer)
+    photo_bytes = db.Column(db.Integer)
+    photo_color = db.Column(db.String(7))
+    photo_blurhash = db.Column(db.String(32))
+    # The dHash in hex, and its bands (app.similarity.bands) which are
+    # indexed for near duplicate lookups
+    photo_dhash = db.Column(db.String(16))
+    photo_dhash_0 = db.Column(db.Integer, index=True)
+    photo_dhash_1 = db.Column(db.Integer, index=True)
+    photo_dhash_2 = db.Column(db.Integer, index=True)
+    photo_dhash_3 = db.Column(db.Integer, index=True)
     comments = db.relationship('Comment', backref='post', lazy='dynamic',
                                cascade='all, delete-orphan')
 
@@ -338,36 +598,141 @@ class Post(db.Model):
             markdown(value, output_format='html'),
             tags=allowed_tags, strip=True))
 
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        '''
+        Fan the new post out to the timelines of the author's followers.
+        Authors above APP_TIMELINE_FANOUT_LIMIT followers are switched to
+        fan-out-on-read and their posts are merged in by followed_posts.
+        '''
+        users = User.__table__
+        follows = Follow.__table__
+        update_counter(connection, users.c.post_count, target.author_id, 1)
+        author = connection.execute(
+            select([users.c.fanout_on_read, users.c.follower_count])
+            .where(users.c.id == target.author_id)).first()
+        if author is None or author.fanout_on_read:
+            return
+        if author.follower_count > \
+                current_app.config['APP_TIMELINE_FANOUT_LIMIT']:
+            connection.execute(users.update()
+                               .where(users.c.id == target.author_id)
+                               .values(fanout_on_read=True))
+            return
+        connection.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id'],
+            select([follows.c.follower_id, literal(target.id)])
+            .where(follows.c.followed_id == target.author_id)))
+
+    @staticmethod
+    def on_deleting(mapper, connection, target):
+        timelines = Timeline.__table__
+        connection.execute(timelines.delete()
+                           .where(timelines.c.post_id == target.id))
+        update_counter(connection, User.__table__.c.post_count,
+                       target.author_id, -1)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        '''
+        Note the photo of a deleted post, which is removed when the
+        session commits unless other posts share it
+        '''
+        if target.imagefile:
+            session = object_session(target)
+            session.info.setdefault('deleted_photos', set()).add(
+                target.imagefile)
+
     def delete(self):
         '''
-        Delete this object from db
+        Delete this object from db, along with its photo unless other
+        posts share it
         '''
-        # Delete associated file
-        import os
-        os.remove(os.path.join(current_app.config['UPLOADS_DIR'],
-                               self.imagefile))
         db.session.delete(self)
         db.session.commit()
 
-    def to_json(self):
-        image_url = ''
-        if self.imagefile:
-            image_url = url_for('main.uploaded_photos',
-                                filename=self.imagefile,
-                                _external=True)
-        json_post = {
-            'id': self.id,
-            'url': url_for('api.get_post', id=self.id, _external=True),
-            'img_url': image_url,
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author': url_for('api.get_user', id=self.author_id,
-                              _external=True),
-            'comments': url_for('api.get_post_comments', id=self.id,
-                                _external=True),
-            'comment_count': self.comments.count()
-        }
+    @staticmethod
+    def photo_references(imagefile):
+        '''
+        Number of posts that use a stored photo
+        '''
+        return Post.query.filter_by(imagefile=imagefile).count()
+
+    @staticmethod
+    def set_photo_metadata(imagefile, metadata):
+        '''
+        Store the photo columns that app.photos.analyze_image returns in
+        every post of a photo
+        '''
+        Post.query.filter_by(imagefile=imagefile).update(
+            metadata, synchronize_session=False)
+        db.session.commit()
+
+    _photo_columns = ('photo_width', 'photo_height', 'photo_bytes',
+                      'photo_color', 'photo_blurhash', 'photo_dhash',
+                      'photo_dhash_0', 'photo_dhash_1', 'photo_dhash_2',
+                      'photo_dhash_3')
+
+    def photo_metadata(self):
+        '''
+        The photo columns of this post, for posts of the same photo
+        '''
+        return dict((name, getattr(self, name))
+                    for name in Post._photo_columns)
+
+    @staticmethod
+    def similar_photos(dhash, max_distance, author=None):
+        '''
+        (photo, distance) of the photos of posts, of author when given,
+        whose dHash is within max_distance bits of dhash, the nearest
+        first. Photos have imagefile, photo_dhash, photo_width and
+        photo_height. Only the posts that share a band within
+        max_distance // BANDS bits are read, through the band indexes.
+        '''
+        radius = max_distance // similarity.BANDS
+        query = db.session.query(
+            Post.imagefile, Post.photo_dhash, Post.photo_width,
+            Post.photo_height).distinct().filter(db.or_(*[
+                getattr(Post, 'photo_dhash_%d' % i).in_(
+                    list(similarity.neighbours(band, radius)))
+                for i, band in enumerate(similarity.bands(dhash))]))
+        if author is not None:
+            query = query.filter(Post.author_id == author.id)
+        found = [(photo, similarity.distance(dhash,
+                                             int(photo.photo_dhash, 16)))
+                 for photo in query]
+        return sorted([(photo, distance) for photo, distance in found
+                       if distance <= max_distance],
+                      key=lambda item: item[1])
+
+    _json_fields = (
+        ('id', lambda p: p.id),
+        ('url', lambda p: external_url('api.get_post', id=p.id)),
+        ('img_url', lambda p: p.imagefile and external_url(
+            'main.uploaded_photos', filename=p.imagefile) or ''),
+        ('thumbnails', lambda p: dict(
+            (str(size), external_url('main.uploaded_photos',
+                                     filename=p.imagefile, size=size))
+            for size in current_app.config['APP_THUMBNAIL_SIZES']
+            if p.imagefile)),
+        ('img_width', lambda p: p.photo_width),
+        ('img_height', lambda p: p.photo_height),
+        ('img_bytes', lambda p: p.photo_bytes),
+        ('img_color', lambda p: p.photo_color),
+        ('img_blurhash', lambda p: p.photo_blurhash),
+        ('body', lambda p: p.body),
+        ('body_html', lambda p: p.body_html),
+        ('timestamp', lambda p: p.timestamp),
+        ('author', lambda p: external_url('api.get_user', id=p.author_id)),
+        ('comments', lambda p: external_url('api.get_post_comments',
+                                            id=p.id)),
+        ('comment_count', lambda p: p.comment_count)
+    )
+
+    def to_json(self, fields=None, expand=()):
+        json_post = select_fields(self, Post._json_fields, fields)
+        if 'author' in expand:
+            json_post['author'] = self.author.to_json()
         return json_post
 
     @staticmethod
@@ -379,6 +744,14 @@ class Post(db.Model):
 
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)
+db.event.listen(Post, 'after_insert', Post.on_inserted)
+db.event.listen(Post, 'before_delete', Post.on_deleting)
+db.event.listen(Post, 'after_delete', Post.on_deleted)
+db.event.listen(Follow, 'after_insert', Follow.on_inserted)
+db.event.listen(Follow, 'after_delete', Follow.on_deleted)
+db.event.listen(User, 'before_delete', User.on_deleting)
+db.event.listen(User, 'after_update', User.on_updated)
+db.event.listen(User, 'after_delete', User.on_deleted)
 
 
 class Comment(db.Model):
@@ -399,16 +772,33 @@ class Comment(db.Model):
             markdown(value, output_format='html'),
             tags=allowed_tags, strip=True))
 
-    def to_json(self):
-        json_comment = {
-            'url': url_for('api.get_comment', id=self.id, _external=True),
-            'post': url_for('api.get_post', id=self.post_id, _external=True),
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author': url_for('api.get_user', id=self.author_id,
-                              _external=True),
-        }
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        update_counter(connection, Post.__table__.c.comment_count,
+                       target.post_id, 1)
+        update_counter(connection, User.__table__.c.comment_count,
+                       target.author_id, 1)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        update_counter(connection, Post.__table__.c.comment_count,
+                       target.post_id, -1)
+        update_counter(connection, User.__table__.c.comment_count,
+                       target.author_id, -1)
+
+    _json_fields = (
+        ('url', lambda c: external_url('api.get_comment', id=c.id)),
+        ('post', lambda c: external_url('api.get_post', id=c.post_id)),
+        ('body', lambda c: c.body),
+        ('body_html', lambda c: c.body_html),
+        ('timestamp', lambda c: c.timestamp),
+        ('author', lambda c: external_url('api.get_user', id=c.author_id))
+    )
+
+    def to_json(self, fields=None, expand=()):
+        json_comment = select_fields(self, Comment._json_fields, fields)
+        if 'author' in expand:
+            json_comment['author'] = self.author.to_json()
         return json_comment
 
     @staticmethod
@@ -420,3 +810,88 @@ class Comment(db.Model):
 
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Comment, 'after_insert', Comment.on_inserted)
+db.event.listen(Comment, 'after_delete', Comment.on_deleted)
+
+
+class OutboxEmail(db.Model):
+    '''
+    Email waiting to be rendered and sent by 'manage.py dispatch_email'.
+    next_attempt_at is cleared once the email is sent or given up on.
+    claim identifies the dispatcher that last leased the email.
+    '''
+    __tablename__ = 'outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(64))
+    subject = db.Column(db.String(128))
+    template = db.Column(db.String(64))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    context = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, index=True,
+                                default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    claim = db.Column(db.String(32))
+
+    def __repr__(self):
+        return '<OutboxEmail %r to %r>' % (self.template, self.recipient)
+
+
+def repair_counters(batch_size=1000):
+    '''
+    Recompute the denormalized counters from the underlying tables,
+    batch_size rows at a time, and return the number of rows repaired
+    '''
+    users = User.__table__
+    posts = Post.__table__
+    comments = Comment.__table__
+    follows = Follow.__table__
+
+    def count(table, column, owner):
+        return select([func.count()]).select_from(table)\
+            .where(column == owner.c.id).as_scalar()
+
+    user_counts = {
+        'post_count': count(posts, posts.c.author_id, users),
+        'comment_count': count(comments, comments.c.author_id, users),
+        'follower_count': count(follows, follows.c.followed_id, users),
+        'followed_count': count(follows, follows.c.follower_id, users)
+    }
+    post_counts = {
+        'comment_count': count(comments, comments.c.post_id, posts)
+    }
+    repaired = 0
+    for table, counts in ((users, user_counts), (posts, post_counts)):
+        stale = db.or_(*[db.or_(table.c[name] == None,
+                                table.c[name] != value)
+                         for name, value in counts.items()])
+        last_id = db.session.query(func.max(table.c.id)).scalar() or 0
+        for start in range(0, last_id, batch_size):
+            result = db.session.execute(
+                table.update().values(counts)
+                .where(table.c.id > start)
+                .where(table.c.id <= start + batch_size)
+                .where(stale))
+            repaired += result.rowcount
+            db.session.commit()
+    return repaired
+
+
+def remove_deleted_photos(session):
+    '''
+    Hand the photos of the posts deleted by a committed transaction to
+    the deletion queue
+    '''
+    names = session.info.pop('deleted_photos', None)
+    if names and has_app_context():
+        deletion_queue().schedule(names)
+
+
+def forget_deleted_photos(session):
+    session.info.pop('deleted_photos', None)
+
+
+db.event.listen(SignallingSession, 'after_commit', remove_deleted_photos)
+db.event.listen(SignallingSession, 'after_rollback', forget_deleted_photos)
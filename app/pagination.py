@@ -0,0 +1,203 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from math import ceil
+import time
+from flask import current_app, request, url_for
+from sqlalchemy import text
+from . import db
+from .exceptions import ValidationError
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class CursorPagination(object):
+    '''
+    Keyset pagination ordered on a (timestamp, id) key.
+
+    Each page is fetched with a WHERE clause on the key of the row that
+    bounds it, so deep pages cost the same as the first one and no
+    COUNT(*) is needed. Cursors are opaque to clients: they encode the
+    direction to move in and the key of the boundary row.
+    '''
+    def __init__(self, query, key, cursor, per_page, ascending=False):
+        timestamp, id = key
+        self.per_page = per_page
+        forward, boundary = True, None
+        if cursor:
+            forward, boundary = self.decode(cursor)
+        descending = forward != ascending
+        if boundary is not None:
+            t, i = boundary
+            if descending:
+                query = query.filter((timestamp < t) |
+                                     ((timestamp == t) & (id < i)))
+            else:
+                query = query.filter((timestamp > t) |
+                                     ((timestamp == t) & (id > i)))
+        if descending:
+            query = query.order_by(timestamp.desc(), id.desc())
+        else:
+            query = query.order_by(timestamp.asc(), id.asc())
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if forward:
+            self.has_prev = boundary is not None
+            self.has_next = more
+        else:
+            items.reverse()
+            self.has_prev = more
+            self.has_next = True
+        self.items = items
+        self._timestamp = timestamp.key
+        self._id = id.key
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        return self.encode(False, self.items[0])
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return self.encode(True, self.items[-1])
+
+    def encode(self, forward, item):
+        token = '%s|%s|%d' % ('n' if forward else 'p',
+                              getattr(item, self._timestamp).strftime(
+                                  CURSOR_TIMESTAMP_FORMAT),
+                              getattr(item, self._id))
+        return urlsafe_b64encode(token.encode('ascii')).decode('ascii')\
+            .rstrip('=')
+
+    @staticmethod
+    def decode(cursor):
+        try:
+            cursor = str(cursor)
+            token = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            direction, timestamp, id = token.decode('ascii').split('|')
+            if direction not in ('n', 'p'):
+                raise ValueError(direction)
+            return direction == 'n', \
+                (datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT),
+                 int(id))
+        except (TypeError, ValueError, UnicodeError):
+            raise ValidationError('invalid cursor')
+
+
+def paginate_collection(query, endpoint, per_page, order_by, key,
+                        ascending=False, **values):
+    '''
+    Paginate an API collection.
+
+    Requests that carry a ``cursor`` argument (empty for the first page)
+    get keyset pagination on ``key``, a (timestamp, id) pair of columns,
+    with ``prev``/``next`` links and a ``next_cursor``. Other requests
+    keep the original ``page`` based pagination ordered by ``order_by``.
+    Returns the page items and a dict with the pagination fields of the
+    response. The links keep the ``fields`` and ``expand`` arguments of
+    the request.
+    '''
+    for name in ('fields', 'expand'):
+        if name in request.args:
+            values.setdefault(name, request.args[name])
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        pagination = CursorPagination(query, key, cursor, per_page,
+                                      ascending=ascending)
+        prev = None
+        if pagination.prev_cursor:
+            prev = url_for(endpoint, cursor=pagination.prev_cursor,
+                           _external=True, **values)
+        next = None
+        if pagination.next_cursor:
+            next = url_for(endpoint, cursor=pagination.next_cursor,
+                           _external=True, **values)
+        return pagination.items, {
+            'prev': prev,
+            'next': next,
+            'next_cursor': pagination.next_cursor
+        }
+    page = request.args.get('page', 1, type=int)
+    pagination = query.order_by(order_by).paginate(
+        page, per_page=per_page, error_out=False)
+    prev = None
+    if pagination.has_prev:
+        prev = url_for(endpoint, page=page-1, _external=True, **values)
+    next = None
+    if pagination.has_next:
+        next = url_for(endpoint, page=page+1, _external=True, **values)
+    return pagination.items, {
+        'prev': prev,
+        'next': next,
+        'count': pagination.total
+    }
+
+
+class CountFreePagination(object):
+    '''
+    Page based pagination that never counts the rows of the listing.
+
+    One extra row is fetched to tell whether there is a next page. The
+    total is optional: it can be given as a number or as a callable that
+    returns a cached or estimated count, and is only evaluated when a
+    template asks for it.
+    '''
+    def __init__(self, query, page, per_page, total=None):
+        if page < 1:
+            page = 1
+        self.page = page
+        self.per_page = per_page
+        items = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+        self.has_next = len(items) > per_page
+        self.items = items[:per_page]
+        self.has_prev = page > 1
+        self.prev_num = page - 1
+        self.next_num = page + 1
+        self._total = total
+
+    @property
+    def total(self):
+        if callable(self._total):
+            self._total = self._total()
+        return self._total
+
+    @property
+    def pages(self):
+        if self.total is None:
+            return None
+        return max(int(ceil(self.total / float(self.per_page))), self.page)
+
+
+def paginate(query, page, per_page, total=None):
+    '''
+    Paginate an HTML listing, without an exact COUNT(*) unless
+    APP_COUNT_FREE_PAGINATION is turned off.
+    '''
+    if not current_app.config['APP_COUNT_FREE_PAGINATION']:
+        return query.paginate(page, per_page=per_page, error_out=False)
+    return CountFreePagination(query, page, per_page, total=total)
+
+
+def estimated_count(model):
+    '''
+    Approximate number of rows in the table of a model. Postgres
+    provides an estimate in its catalog; other databases get an exact
+    count that is cached for APP_COUNT_CACHE_TTL seconds.
+    '''
+    table = model.__tablename__
+    if db.engine.dialect.name == 'postgresql':
+        estimate = db.session.execute(
+            text('SELECT reltuples FROM pg_class WHERE relname = :table'),
+            {'table': table}).scalar()
+        if estimate is not None and estimate >= 0:
+            return int(estimate)
+    cache = current_app.extensions.setdefault('count_cache', {})
+    count, expires = cache.get(table, (None, 0))
+    now = time.time()
+    if expires < now:
+        count = model.query.count()
+        cache[table] = (count, now + current_app.config['APP_COUNT_CACHE_TTL'])
+    return count
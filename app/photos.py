@@ -0,0 +1,846 @@
+import atexit
+import errno
+import hashlib
+import multiprocessing
+import os
+import posixpath
+import shutil
+import tempfile
+import threading
+import time
+from six.moves import queue
+from flask import current_app, Request
+from PIL import Image, ImageOps, features
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from . import db, blurhash, similarity
+from .cache import get_cache, invalidate
+from .storage import get_storage, open_storage, storage_settings
+
+try:
+    import pillow_avif  # registers the AVIF plugin of Pillow
+except ImportError:
+    pillow_avif = None
+
+CHUNK_SIZE = 64 * 1024
+# Hex digits of the SHA-256 of a photo kept in its file name, which fits
+# Post.imagefile along with the extension
+DIGEST_LENGTH = 24
+_extensions = {'.jpeg': '.jpg', '.jpe': '.jpg'}
+# Leading bytes of the image formats accepted for photos
+_signatures = (
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'BM', '.bmp')
+)
+SNIFF_LENGTH = 256
+# Thumbnails keep transparency as PNG, everything else becomes JPEG
+_thumbnail_extensions = {'.png': '.png', '.gif': '.png'}
+_thumbnail_formats = {'.png': 'PNG', '.jpg': 'JPEG'}
+# Formats photos are transcoded to, from the most compact
+_transcodings = (
+    ('.avif', 'AVIF', 'image/avif'),
+    ('.webp', 'WEBP', 'image/webp')
+)
+_transcode_formats = dict((ext, format) for ext, format, mimetype
+                          in _transcodings)
+# Pixels photos are scaled down to for their color and BlurHash
+ANALYSIS_SIZE = 32
+# Colors photos are reduced to, the most common being their dominant one
+ANALYSIS_COLORS = 5
+_pool_lock = threading.Lock()
+_deletion_lock = threading.Lock()
+
+
+def photo_filename(digest, filename):
+    '''
+    File name of a photo from the hex digest of its contents and the name
+    it was uploaded with
+    '''
+    ext = os.path.splitext(filename)[1].lower()
+    return digest[:DIGEST_LENGTH] + _extensions.get(ext, ext)
+
+
+def shard(name):
+    '''
+    Directory of the storage key of a stored file. Photos are fanned out
+    over two levels named after the first characters of their digest,
+    which their thumbnails and versions share.
+    '''
+    return posixpath.join(name[:2], name[2:4])
+
+
+def storage_path(name):
+    '''
+    Storage key of a stored file
+    '''
+    return posixpath.join(shard(name), name)
+
+
+def is_stored(name):
+    '''
+    Whether name is stored, cached since remote storages answer with a
+    round trip. Files that are missing are only cached for
+    APP_PHOTO_FALLBACK_MAX_AGE seconds, as their thumbnails may be on
+    the way.
+    '''
+    key = storage_path(name)
+    cache = get_cache('stored')
+    stored = cache.get(key)
+    if stored is None:
+        stored = get_storage().exists(key)
+        cache.set(key, stored, None if stored else
+                  current_app.config['APP_PHOTO_FALLBACK_MAX_AGE'])
+    return stored
+
+
+def _store(tmp, name):
+    '''
+    Move the temporary file tmp to the storage, unless that photo is
+    already stored. A stored photo is touched instead, which keeps the
+    deletion queue and gc_uploads from removing it before the post of
+    the upload is committed.
+    '''
+    storage = get_storage()
+    if storage.touch(storage_path(name)):
+        os.remove(tmp)
+    else:
+        storage.put_file(storage_path(name), tmp)
+        invalidate('stored', storage_path(name))
+
+
+def hash_file(f):
+    sha = hashlib.sha256()
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def sniff_image(head):
+    '''
+    Extension of the image format that data starting with head is in,
+    None if it is not an image
+    '''
+    for signature, ext in _signatures:
+        if head.startswith(signature):
+            return ext
+    text = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if text.startswith(b'<?xml') or text.startswith(b'<svg') or \
+            text.startswith(b'<!DOCTYPE svg'):
+        return '.svg'
+    return None
+
+
+class PhotoUpload(object):
+    '''
+    Writable temporary file of UPLOADS_DIR that the form parser streams a
+    photo into. The contents are hashed and their image type sniffed as
+    they are written, so that the upload is rejected as soon as it is not
+    an image or grows past max_size, and stored by moving the file to
+    the storage, which is a rename when that is UPLOADS_DIR. The file is
+    removed when the request is closed unless it was stored.
+    '''
+    def __init__(self, uploads, max_size):
+        fd, self.path = tempfile.mkstemp(dir=uploads, prefix='.upload-')
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha = hashlib.sha256()
+        self._head = b''
+        self.max_size = max_size
+        self.size = 0
+        self.ext = None
+        self.name = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.close()
+            raise RequestEntityTooLarge()
+        if self.ext is None:
+            self._head += data[:SNIFF_LENGTH - len(self._head)]
+            if len(self._head) >= SNIFF_LENGTH:
+                self._sniff()
+        self._sha.update(data)
+        self._file.write(data)
+
+    def _sniff(self):
+        self.ext = sniff_image(self._head)
+        if self.ext is None:
+            self.close()
+            raise UnsupportedMediaType('Photos must be images')
+
+    def store(self):
+        '''
+        Move the file to the storage under its content addressed name and
+        return the name
+        '''
+        if self.ext is None:
+            self._sniff()
+        self._file.flush()
+        name = self._sha.hexdigest()[:DIGEST_LENGTH] + self.ext
+        _store(self.path, name)
+        self.name = name
+        return name
+
+    def close(self):
+        self._file.close()
+        if self.name is None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class PhotoUploadRequest(Request):
+    '''
+    Request class that streams the files posted to photo_endpoints into
+    PhotoUpload files instead of memory or anonymous temporary files
+    '''
+    photo_endpoints = frozenset(['main.index'])
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if self.endpoint not in self.photo_endpoints:
+            return Request._get_file_stream(
+                self, total_content_length, content_type, filename,
+                content_length)
+        return PhotoUpload(current_app.config['UPLOADS_DIR'],
+                           current_app.config['MAX_CONTENT_LENGTH'])
+
+
+def save_photo(stream, filename):
+    '''
+    Store an uploaded photo under the digest of its contents and return
+    its file name. Streams of PhotoUploadRequest are already hashed;
+    others are hashed while they are copied to a temporary file of
+    UPLOADS_DIR. The file is then moved to the storage, unless the photo
+    is already stored.
+    '''
+    if isinstance(stream, PhotoUpload):
+        return stream.store()
+    uploads = current_app.config['UPLOADS_DIR']
+    fd, tmp = tempfile.mkstemp(dir=uploads, prefix='.upload-')
+    try:
+        sha = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+                f.write(chunk)
+        name = photo_filename(sha.hexdigest(), filename)
+        _store(tmp, name)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return name
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def remove_photo(name):
+    '''
+    Delete a stored photo, its thumbnails and their transcoded versions,
+    which may already be gone
+    '''
+    storage = get_storage()
+    names = [name]
+    if has_thumbnails(name):
+        names += [thumbnail_filename(name, size)
+                  for size in current_app.config['APP_THUMBNAIL_SIZES']]
+    names += [transcoded_filename(name, ext) for name in names
+              for ext, format, mimetype in _transcodings]
+    keys = [storage_path(name) for name in names]
+    storage.delete_many(keys)
+    for key in keys:
+        invalidate('stored', key)
+
+
+def has_thumbnails(name):
+    '''
+    Whether thumbnails are made of a photo, vector images scale by
+    themselves
+    '''
+    return os.path.splitext(name)[1] != '.svg'
+
+
+def thumbnail_filename(name, size):
+    '''
+    File name of the thumbnail of a stored photo that fits in a square of
+    size pixels, next to the photo
+    '''
+    stem, ext = os.path.splitext(name)
+    return '%s-%d%s' % (stem, size, _thumbnail_extensions.get(ext, '.jpg'))
+
+
+def transcoded_filename(name, ext):
+    '''
+    File name of a stored photo or thumbnail transcoded to the format of
+    extension ext
+    '''
+    return os.path.splitext(name)[0] + ext
+
+
+def transcode_formats():
+    '''
+    Extensions of the formats photos can be transcoded to with the
+    codecs Pillow was built with
+    '''
+    Image.init()
+    return [ext for ext, format, mimetype in _transcodings
+            if format in Image.SAVE and
+            (format != 'WEBP' or features.check('webp'))]
+
+
+def _save(image, directory, name, format, max_size=None, **params):
+    '''
+    Write image to the file name of directory through a temporary
+    file, unless the result is not smaller than max_size bytes. Returns whether
+    the file was written.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.thumbnail-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format, **params)
+        if max_size is not None and os.path.getsize(tmp) >= max_size:
+            os.remove(tmp)
+            return False
+        os.rename(tmp, os.path.join(directory, name))
+    except:
+        _remove(tmp)
+        raise
+    return True
+
+
+def _convert(image, modes):
+    if image.mode in modes:
+        return image
+    alpha = 'A' in image.mode or 'transparency' in image.info
+    return image.convert('RGBA' if alpha and 'RGBA' in modes else 'RGB')
+
+
+def _transcode(image, directory, name, qualities, force):
+    '''
+    Write the versions of the stored file name, whose pixels are image,
+    in the transcoding formats, skipping those that would be larger
+    '''
+    made = []
+    image = _convert(image, ('RGB', 'RGBA'))
+    size = os.path.getsize(os.path.join(directory, name))
+    for ext in qualities:
+        transcoded = transcoded_filename(name, ext)
+        path = os.path.join(directory, transcoded)
+        if os.path.exists(path) and not force:
+            continue
+        if _save(image, directory, transcoded, _transcode_formats[ext],
+                 size, quality=qualities[ext]):
+            made.append(transcoded)
+    return made
+
+
+def make_thumbnails(directory, name, sizes, quality, transcode=None,
+                    force=False):
+    '''
+    Write the thumbnails of the photo name of directory that are smaller
+    than the photo itself, and the versions of the photo and of its
+    thumbnails in the formats of transcode, which maps extensions to the
+    quality used for each size (None for the photo). Returns the names of
+    the files written. Runs in the processes of the thumbnail pool,
+    without an application context.
+    '''
+    transcode = transcode or {}
+
+    def qualities(size):
+        return dict((ext, transcode[ext][size]) for ext in transcode
+                    if size in transcode[ext])
+    image = Image.open(os.path.join(directory, name))
+    image = ImageOps.exif_transpose(image)
+    made = []
+    # animations would lose all but their first frame
+    if not getattr(image, 'is_animated', False):
+        made += _transcode(image, directory, name, qualities(None), force)
+    # each size is scaled down from the previous, larger one
+    for size in sorted(sizes, reverse=True):
+        if max(image.size) <= size:
+            continue
+        thumbnail = thumbnail_filename(name, size)
+        ext = os.path.splitext(thumbnail)[1]
+        if ext == '.png':
+            image = _convert(image, ('RGB', 'RGBA', 'L', 'LA'))
+        else:
+            image = _convert(image, ('RGB', 'L'))
+        image.thumbnail((size, size), Image.LANCZOS)
+        if force or not os.path.exists(os.path.join(directory, thumbnail)):
+            _save(image, directory, thumbnail, _thumbnail_formats[ext],
+                  quality=quality, optimize=True)
+            made.append(thumbnail)
+        made += _transcode(image, directory, thumbnail, qualities(size),
+                           force)
+    return made
+
+
+def process_photo(settings, name, sizes, quality, transcode=None,
+                  force=False):
+    '''
+    Run make_thumbnails on a photo of the storage that settings describe.
+    Photos of local directories are processed in place, others in a
+    temporary directory, from which everything is uploaded again.
+    '''
+    storage = open_storage(settings)
+    path = storage.local_path(storage_path(name))
+    if path is not None:
+        return make_thumbnails(os.path.dirname(path), name, sizes, quality,
+                               transcode, force)
+    directory = tempfile.mkdtemp()
+    try:
+        storage.fetch(storage_path(name), os.path.join(directory, name))
+        made = make_thumbnails(directory, name, sizes, quality, transcode,
+                               force)
+        for made_name in made:
+            storage.put_file(storage_path(made_name),
+                             os.path.join(directory, made_name))
+        return made
+    finally:
+        shutil.rmtree(directory)
+
+
+def thumbnail_job(args):
+    '''
+    process_photo for Pool.imap, returning the name of the photo and
+    either the files written or the error raised
+    '''
+    try:
+        return args[1], process_photo(*args)
+    except Exception as e:
+        return args[1], e
+
+
+def thumbnail_pool():
+    '''
+    Pool of APP_THUMBNAIL_WORKERS processes of the current application,
+    started on first use, in which the thumbnails are made so that image
+    decoding neither blocks requests nor holds the interpreter lock
+    '''
+    pool = current_app.extensions.get('thumbnail_pool')
+    if pool is None:
+        with _pool_lock:
+            pool = current_app.extensions.get('thumbnail_pool')
+            if pool is None:
+                pool = current_app.extensions['thumbnail_pool'] = \
+                    multiprocessing.Pool(
+                        current_app.config['APP_THUMBNAIL_WORKERS'])
+    return pool
+
+
+def thumbnail_args(name, force=False):
+    config = current_app.config
+    formats = transcode_formats()
+    transcode = dict((ext, quality) for ext, quality
+                     in config['APP_TRANSCODE_QUALITY'].items()
+                     if ext in formats)
+    return (storage_settings(config), name, config['APP_THUMBNAIL_SIZES'],
+            config['APP_THUMBNAIL_QUALITY'], transcode, force)
+
+
+def generate_thumbnails(name):
+    '''
+    Queue the thumbnails of a stored photo in the thumbnail pool and
+    return the AsyncResult of thumbnail_job, None when it has no
+    thumbnails. Until they are written the photo is served in full size.
+    '''
+    if not has_thumbnails(name):
+        return None
+    app = current_app._get_current_object()
+
+    def report(result):
+        # runs in the result thread of the pool, nobody waits for errors
+        if isinstance(result[1], Exception):
+            app.logger.error('Making the thumbnails of %s failed: %r',
+                             name, result[1])
+    return thumbnail_pool().apply_async(
+        thumbnail_job, (thumbnail_args(name),), callback=report)
+
+
+def _flatten(image):
+    '''
+    RGB version of image, with its transparent areas over white
+    '''
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        image = Image.alpha_composite(
+            Image.new('RGBA', image.size, (255, 255, 255, 255)), image)
+    return image.convert('RGB')
+
+
+def _reduced(path):
+    '''
+    Width and height of the image file path as it is shown, and the image
+    scaled down to ANALYSIS_SIZE pixels
+    '''
+    image = Image.open(path)
+    width, height = image.size
+    # orientations above 4 turn the photo by a quarter
+    if image.getexif().get(0x0112, 1) > 4:
+        width, height = height, width
+    # JPEG photos are decoded at a fraction of their size
+    image.draft('RGB', (ANALYSIS_SIZE * 2, ANALYSIS_SIZE * 2))
+    image = _flatten(ImageOps.exif_transpose(image))
+    image.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE), Image.LANCZOS)
+    return width, height, image
+
+
+def _hash_columns(width, height, image):
+    dhash = similarity.dhash(image)
+    columns = {
+        'photo_width': width,
+        'photo_height': height,
+        'photo_dhash': '%016x' % dhash
+    }
+    for i, band in enumerate(similarity.bands(dhash)):
+        columns['photo_dhash_%d' % i] = band
+    return columns
+
+
+def hash_image(path):
+    '''
+    Width, height and dHash of the image file path, keyed by the photo
+    columns of Post. The image is only decoded at a reduced size, which
+    is cheap enough for requests.
+    '''
+    return _hash_columns(*_reduced(path))
+
+
+def analyze_image(path):
+    '''
+    hash_image of the image file path, along with its byte size, dominant
+    color and BlurHash
+    '''
+    width, height, image = _reduced(path)
+    colors = image.quantize(ANALYSIS_COLORS)
+    count, index = max(colors.getcolors())
+    metadata = _hash_columns(width, height, image)
+    metadata.update({
+        'photo_bytes': os.path.getsize(path),
+        'photo_color': '#%02x%02x%02x' % tuple(
+            colors.getpalette()[index * 3:index * 3 + 3]),
+        'photo_blurhash': blurhash.encode(image)
+    })
+    return metadata
+
+
+def _analyze_stored(storage, name, analyze):
+    '''
+    analyze(path) of a stored photo, which is fetched to a temporary
+    directory unless it is local
+    '''
+    path = storage.local_path(storage_path(name))
+    if path is not None:
+        return analyze(path)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, name)
+        storage.fetch(storage_path(name), path)
+        return analyze(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def photo_metadata(settings, name):
+    '''
+    analyze_image of a photo of the storage that settings describe
+    '''
+    return _analyze_stored(open_storage(settings), name, analyze_image)
+
+
+def metadata_job(args):
+    '''
+    photo_metadata for Pool.imap, like thumbnail_job
+    '''
+    try:
+        return args[1], photo_metadata(*args)
+    except Exception as e:
+        return args[1], e
+
+
+def extract_metadata(name):
+    '''
+    Queue the analysis of a stored photo in the thumbnail pool and return
+    the AsyncResult, None for photos that are not decoded. The results
+    are written to the posts of the photo, which should be committed
+    first.
+    '''
+    if not has_thumbnails(name):
+        return None
+    from .models import Post
+    app = current_app._get_current_object()
+
+    def store(metadata):
+        # runs in the result thread of the pool, which must not fail
+        try:
+            with app.app_context():
+                Post.set_photo_metadata(name, metadata)
+        except Exception:
+            app.logger.exception('Storing the metadata of %s failed', name)
+    return thumbnail_pool().apply_async(
+        photo_metadata, (storage_settings(app.config), name),
+        callback=store)
+
+
+def hash_upload(name):
+    '''
+    hash_image of a photo just stored, computed in the request rather
+    than behind the jobs of the thumbnail pool. None for photos that are
+    not decoded, and when decoding fails.
+    '''
+    if not has_thumbnails(name):
+        return None
+    try:
+        return _analyze_stored(get_storage(), name, hash_image)
+    except Exception:
+        current_app.logger.warning('Hashing %s failed', name,
+                                   exc_info=True)
+        return None
+
+
+def find_duplicate(name, columns, author):
+    '''
+    (post, reusable) of the post of author whose photo is the nearest
+    duplicate of the photo name, whose columns hash_upload returned,
+    within APP_DUPLICATE_DISTANCE bits. None if there is none. Near
+    duplicates are often edits of the photo, so only a photo with the
+    same dHash that is at least as large is reusable instead of name.
+    '''
+    from .models import Post
+    pixels = columns['photo_width'] * columns['photo_height']
+    for photo, distance in Post.similar_photos(
+            int(columns['photo_dhash'], 16),
+            current_app.config['APP_DUPLICATE_DISTANCE'], author):
+        if photo.imagefile != name:
+            post = Post.query.filter_by(imagefile=photo.imagefile,
+                                        author_id=author.id).first()
+            return post, distance == 0 and \
+                photo.photo_width * photo.photo_height >= pixels
+    return None
+
+
+def sized_photo(name, size=None):
+    '''
+    File name to serve for a stored photo displayed at size pixels: its
+    smallest thumbnail that is at least as large, or the photo itself
+    when that thumbnail does not exist
+    '''
+    if size is None or not has_thumbnails(name):
+        return name
+    for thumbnail_size in sorted(current_app.config['APP_THUMBNAIL_SIZES']):
+        if thumbnail_size >= size:
+            thumbnail = thumbnail_filename(name, thumbnail_size)
+            if is_stored(thumbnail):
+                return thumbnail
+            break
+    return name
+
+
+def transcoded_photo(name, accept_mimetypes):
+    '''
+    File name to serve for the stored file name to a client that accepts
+    accept_mimetypes: its version in the most compact format the client
+    lists explicitly, or the file itself when there is none
+    '''
+    accepted = set(mimetype for mimetype, quality in accept_mimetypes
+                   if quality > 0)
+    for ext, format, mimetype in _transcodings:
+        if mimetype in accepted:
+            transcoded = transcoded_filename(name, ext)
+            if is_stored(transcoded):
+                return transcoded
+    return name
+
+
+def photo_etag(name, st):
+    '''
+    Strong ETag of a stored file. Photos are named after the digest of
+    their contents; thumbnails and transcoded versions can be rewritten
+    under the same name, so the time they were written is added.
+    '''
+    stem, ext = os.path.splitext(posixpath.basename(name))
+    if '-' not in stem and ext not in _transcode_formats:
+        return stem
+    return '%s-%x' % (stem + ext, int(st.st_mtime))
+
+
+class DeletionQueue(object):
+    '''
+    Thread that removes the photos of deleted posts after the deletions
+    are committed, unless other posts still use them. Each photo waits
+    delay seconds first, and is only removed once it has not been
+    stored again, which touches it, for delay seconds. That leaves
+    uploads of the same photo the time to commit their posts, so delay
+    should be longer than uploads take between storing the photo and
+    committing the post. Photos that are not removed, because of errors
+    or because the process exits first, are left for gc_uploads.
+    '''
+    def __init__(self, app, delay):
+        self.app = app
+        self.delay = delay
+        self.queue = queue.Queue()
+        self.removed = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, names):
+        for name in names:
+            self.queue.put((time.time() + self.delay, name))
+
+    def join(self):
+        '''
+        Wait until every scheduled photo has been handled
+        '''
+        self.queue.join()
+
+    def stop(self, timeout=None):
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+    def _work(self):
+        from .models import Post
+        with self.app.app_context():
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    self.queue.task_done()
+                    return
+                due, name = item
+                try:
+                    time.sleep(max(0, due - time.time()))
+                    if Post.photo_references(name) == 0:
+                        modified = get_storage().modified(
+                            storage_path(name))
+                        if modified is not None and \
+                                modified > time.time() - self.delay:
+                            self.queue.put((modified + self.delay, name))
+                        else:
+                            remove_photo(name)
+                            self.removed += 1
+                except Exception:
+                    self.failed += 1
+                    current_app.logger.exception('Removing %s failed', name)
+                finally:
+                    db.session.remove()
+                    self.queue.task_done()
+
+
+def deletion_queue():
+    '''
+    The deletion queue of the current application, started on first use.
+    The photos it holds are removed before the process exits.
+    '''
+    deletions = current_app.extensions.get('photo_deletions')
+    if deletions is None:
+        with _deletion_lock:
+            deletions = current_app.extensions.get('photo_deletions')
+            if deletions is None:
+                app = current_app._get_current_object()
+                deletions = app.extensions['photo_deletions'] = \
+                    DeletionQueue(app, app.config['APP_PHOTO_DELETE_DELAY'])
+                atexit.register(deletions.stop,
+                                app.config['APP_PHOTO_DELETE_DELAY'] + 5)
+    return deletions
+
+
+def photo_key(name):
+    '''
+    The digest part of the name of a stored file, which a photo shares
+    with its thumbnails and versions
+    '''
+    return name.split('.', 1)[0].split('-', 1)[0]
+
+
+def _ascending(keys, what):
+    previous = None
+    for key in keys:
+        if previous is not None and key < previous:
+            raise RuntimeError('%s are not in order: %s after %s' % (
+                what, key, previous))
+        previous = key
+        yield key
+
+
+def find_orphans(stored, referenced):
+    '''
+    Merge join of the (name, key, mtime) tuples of stored files, ordered
+    by name, with the names of the referenced photos in order. Yields the
+    key and mtime of the stored files that belong to no referenced photo,
+    and the temporary files left behind by interrupted writes.
+    '''
+    referenced = _ascending((photo_key(name) for name in referenced),
+                            'Referenced photos')
+    ref = next(referenced, None)
+    previous = None
+    for name, key, mtime in stored:
+        if name.startswith('.'):
+            yield key, mtime
+            continue
+        name_key = photo_key(name)
+        if previous is not None and name_key < previous:
+            raise RuntimeError('Stored files are not in order: %s after %s'
+                               % (name, previous))
+        previous = name_key
+        while ref is not None and ref < name_key:
+            ref = next(referenced, None)
+        if ref != name_key:
+            yield key, mtime
+
+
+def _photo_files(files):
+    '''
+    Groups of the (key, mtime) of files, ordered by name, that belong to
+    the same photo. Temporary files are groups of their own.
+    '''
+    group, group_key = [], None
+    for key, mtime in files:
+        name = posixpath.basename(key)
+        name_key = None if name.startswith('.') else photo_key(name)
+        if group and (name_key is None or name_key != group_key):
+            yield group
+            group = []
+        group.append((key, mtime))
+        group_key = name_key
+    if group:
+        yield group
+
+
+def collect_garbage(grace, dry_run=False):
+    '''
+    Remove the stored files that no post uses and that are older than
+    grace seconds, so that photos whose posts are not committed yet are
+    spared. The files of a photo are kept as long as any of them is
+    recent, and their times are read again before they are removed,
+    since uploads of the photo touch it. Both the storage and the
+    imagefile column are streamed in order, neither is held in memory.
+    Yields the keys of the files.
+    '''
+    from .models import Post
+    storage = get_storage()
+    referenced = (name for name, in db.session.query(Post.imagefile)
+                  .filter(Post.imagefile != None).distinct()
+                  .order_by(Post.imagefile)
+                  .execution_options(stream_results=True).yield_per(1000))
+    oldest = time.time() - grace
+    for group in _photo_files(find_orphans(storage.iter_files(),
+                                           referenced)):
+        if max(mtime for key, mtime in group) >= oldest:
+            continue
+        keys = [key for key, mtime in group]
+        if any((storage.modified(key) or 0) >= oldest for key in keys):
+            continue
+        if not dry_run:
+            storage.delete_many(keys)
+        for key in keys:
+            yield key
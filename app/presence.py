@@ -0,0 +1,80 @@
+import atexit
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import bindparam
+from . import db
+
+
+class PresenceTracker(object):
+    '''
+    Write-behind record of when users were last seen.
+
+    Requests only note the time in memory. The pending times are written
+    at most every flush_interval seconds, with one bulk UPDATE that skips
+    the users whose stored last_seen is less than threshold seconds old.
+    The condition is evaluated by the database, so processes that track
+    the same users never write more often than that nor move last_seen
+    backwards.
+    '''
+    def __init__(self, threshold, flush_interval):
+        self.threshold = timedelta(seconds=threshold)
+        self.flush_interval = timedelta(seconds=flush_interval)
+        self._pending = {}
+        self._last_flush = datetime.utcnow()
+        self._lock = threading.Lock()
+
+    def seen(self, user_id, now=None):
+        '''
+        Record a request of the user, flushing the pending times when the
+        flush interval has elapsed
+        '''
+        now = now or datetime.utcnow()
+        with self._lock:
+            self._pending[user_id] = now
+            due = now - self._last_flush >= self.flush_interval
+        if due:
+            self.flush(now)
+
+    def flush(self, now=None):
+        '''
+        Write the pending times and return the number of rows updated
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = now or datetime.utcnow()
+        if not pending:
+            return 0
+        users = db.metadata.tables['users']
+        stmt = users.update()\
+            .where(users.c.id == bindparam('user_id'))\
+            .where(db.or_(users.c.last_seen == None,
+                          users.c.last_seen < bindparam('stale')))\
+            .values(last_seen=bindparam('seen'))
+        with db.engine.begin() as connection:
+            result = connection.execute(stmt, [
+                {'user_id': user_id, 'seen': seen,
+                 'stale': seen - self.threshold}
+                for user_id, seen in pending.items()])
+        return result.rowcount
+
+
+def _flush_at_exit(app, tracker):
+    with app.app_context():
+        tracker.flush()
+
+
+def presence_tracker():
+    '''
+    The presence tracker of the current application, its pending times
+    are also written when the process exits
+    '''
+    tracker = current_app.extensions.get('presence')
+    if tracker is None:
+        app = current_app._get_current_object()
+        created = PresenceTracker(app.config['APP_LAST_SEEN_THRESHOLD'],
+                                  app.config['APP_PRESENCE_FLUSH_INTERVAL'])
+        tracker = app.extensions.setdefault('presence', created)
+        if tracker is created and not app.testing:
+            atexit.register(_flush_at_exit, app, tracker)
+    return tracker
@@ -0,0 +1,119 @@
+import mimetypes
+import os
+import posixpath
+import stat
+from datetime import datetime
+from flask import current_app, request
+from flask.helpers import safe_join
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import NotFound
+from werkzeug.wsgi import wrap_file
+
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Types the mimetypes module of Python 2 does not know
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+
+def _file_range(f, start, stop):
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _range(size, last_modified, etag):
+    '''
+    The (start, stop) byte range of a file of size bytes requested by the
+    current request, None for the whole file and False when the range
+    cannot be satisfied
+    '''
+    if request.range is None:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag or \
+            if_range.date is not None and if_range.date < last_modified:
+        return None
+    if len(request.range.ranges) != 1:
+        return None
+    return request.range.range_for_length(size) or False
+
+
+def send_stored_file(directory, filename, make_etag, max_age=None):
+    '''
+    Response with the file name of directory, under the strong ETag that
+    make_etag(filename, stat) returns. It is cached for max_age seconds,
+    or for good when that is None. Conditional requests get 304 and
+    single byte ranges 206.
+
+    The bytes are sent through wsgi.file_wrapper, which lets the server
+    use sendfile(), or with APP_SENDFILE set to 'x-sendfile' or
+    'x-accel-redirect' left to the front end web server altogether.
+    '''
+    path = safe_join(directory, filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        raise NotFound()
+    if not stat.S_ISREG(st.st_mode):
+        raise NotFound()
+    etag = make_etag(filename, st)
+    last_modified = datetime.utcfromtimestamp(int(st.st_mtime))
+
+    response = current_app.response_class(
+        mimetype=mimetypes.guess_type(filename)[0] or
+        'application/octet-stream', direct_passthrough=True)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    if max_age is None:
+        response.headers['Cache-Control'] = IMMUTABLE
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = request.if_modified_since is not None and \
+            request.if_modified_since >= last_modified
+    if not_modified:
+        response.status_code = 304
+        return response
+
+    response.content_length = st.st_size
+    sendfile = current_app.config['APP_SENDFILE']
+    if sendfile == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+        return response
+    if sendfile == 'x-accel-redirect':
+        response.headers['X-Accel-Redirect'] = posixpath.join(
+            current_app.config['APP_SENDFILE_PREFIX'],
+            posixpath.normpath(filename))
+        return response
+
+    byte_range = _range(st.st_size, last_modified, etag)
+    if byte_range is False:
+        response.status_code = 416
+        response.content_length = 0
+        response.headers['Content-Range'] = 'bytes */%d' % st.st_size
+        return response
+    if request.method == 'HEAD':
+        return response
+    if byte_range is None:
+        response.response = wrap_file(request.environ, open(path, 'rb'))
+        return response
+    start, stop = byte_range
+    response.status_code = 206
+    response.content_range = ContentRange('bytes', start, stop, st.st_size)
+    response.content_length = stop - start
+    response.response = _file_range(open(path, 'rb'), start, stop)
+    return response
@@ -0,0 +1,141 @@
+import numbers
+import re
+import six
+from flask import current_app, g, has_request_context, request, url_for
+from .exceptions import ValidationError
+
+_safe_value = re.compile(r'^[A-Za-z0-9_.-]+$')
+_int_placeholder = 7770000000000000000
+_str_placeholder = 'urlplaceholder%dx'
+
+
+def _placeholder(index, value):
+    if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+        return _int_placeholder + index
+    if isinstance(value, six.string_types) and _safe_value.match(value):
+        return _str_placeholder % index
+    return None
+
+
+def _compile(endpoint, names, placeholders):
+    '''
+    Build the URL once with placeholder values and split it into the
+    literal chunks that surround each value
+    '''
+    url = url_for(endpoint, _external=True,
+                  **dict(zip(names, placeholders)))
+    positions = sorted((url.index(str(placeholder)), i, len(str(placeholder)))
+                       for i, placeholder in enumerate(placeholders))
+    chunks = []
+    order = []
+    start = 0
+    for position, i, length in positions:
+        chunks.append(url[start:position])
+        order.append(i)
+        start = position + length
+    chunks.append(url[start:])
+    return chunks, order
+
+
+def external_url(endpoint, **values):
+    '''
+    Return url_for(endpoint, _external=True, **values).
+
+    The URL of each endpoint is built by Werkzeug only once per request
+    and kept as a template, later calls fill in the values by string
+    concatenation. Values that Werkzeug would have to quote, and any
+    call made while APP_URL_TEMPLATES is off, go through url_for.
+    '''
+    if not current_app.config['APP_URL_TEMPLATES']:
+        return url_for(endpoint, _external=True, **values)
+    names = sorted(values)
+    placeholders = [_placeholder(i, values[name])
+                    for i, name in enumerate(names)]
+    if None in placeholders:
+        return url_for(endpoint, _external=True, **values)
+    templates = getattr(g, '_url_templates', None)
+    if templates is None:
+        templates = g._url_templates = {}
+    key = (endpoint, tuple(names), tuple(type(p) for p in placeholders),
+           request.url_root if has_request_context() else None)
+    template = templates.get(key)
+    if template is None:
+        template = templates[key] = _compile(endpoint, names, placeholders)
+    chunks, order = template
+    parts = [chunks[0]]
+    for i, chunk in zip(order, chunks[1:]):
+        parts.append(str(values[names[i]]))
+        parts.append(chunk)
+    return ''.join(parts)
+
+
+def select_fields(obj, getters, fields=None):
+    '''
+    Build the JSON dict of obj from (name, getter) pairs, evaluating only
+    the getters of the requested fields (all of them when fields is None)
+    '''
+    return dict((name, get(obj)) for name, get in getters
+                if fields is None or name in fields)
+
+
+def requested_fields():
+    '''
+    The set of attributes asked for with ?fields=a,b or None for all
+    '''
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return frozenset(name.strip() for name in fields.split(','))
+
+
+def requested_expansions(expandable):
+    '''
+    The set of relationships asked for with ?expand=a,b, which must be
+    among expandable
+    '''
+    expand = request.args.get('expand')
+    if not expand:
+        return frozenset()
+    names = frozenset(name.strip() for name in expand.split(','))
+    for name in names - frozenset(expandable):
+        raise ValidationError('cannot expand %s' % name)
+    return names
+
+
+def _preload(items, name):
+    '''
+    Load the objects of the many-to-one relationship name of all items
+    with a single query. The caller must keep the returned list alive so
+    that the session identity map, which lazy loads read from, holds on
+    to them.
+    '''
+    prop = getattr(type(items[0]), name).property
+    (local, remote), = prop.local_remote_pairs
+    ids = set(getattr(item, local.key) for item in items)
+    ids.discard(None)
+    if not ids:
+        return []
+    return prop.mapper.class_.query.filter(remote.in_(ids)).all()
+
+
+def to_json_list(items, expandable=()):
+    '''
+    Serialize items with the fields and expansions of the request,
+    fetching the expanded relationships of the whole list in one query
+    per relationship
+    '''
+    fields = requested_fields()
+    expand = requested_expansions(expandable)
+    if fields is not None:
+        expand &= fields
+    loaded = [_preload(items, name) for name in expand if items]
+    json_items = [item.to_json(fields, expand) for item in items]
+    del loaded
+    return json_items
+
+
+def to_json(item, expandable=()):
+    '''
+    Serialize a single item with the fields and expansions of the request
+    '''
+    return to_json_list([item], expandable)[0]
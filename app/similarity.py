@@ -0,0 +1,74 @@
+from itertools import combinations
+from PIL import Image
+
+# The 64 bits of a dHash are indexed in bands of 16 bits. Hashes within
+# distance d of each other have a band within d // BANDS of each other.
+BANDS = 4
+BAND_BITS = 16
+_band_mask = (1 << BAND_BITS) - 1
+
+
+def dhash(image):
+    '''
+    64 bit difference hash of a PIL image, which near duplicates of the
+    image share, resized or recompressed, but for a few bits
+    '''
+    image = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            value = value << 1 | (left < pixels[row * 9 + column + 1])
+    return value
+
+
+def distance(a, b):
+    '''
+    Hamming distance between two hashes
+    '''
+    return bin(a ^ b).count('1')
+
+
+def bands(value):
+    return [value >> (BAND_BITS * i) & _band_mask for i in range(BANDS)]
+
+
+def neighbours(band, radius):
+    '''
+    Band values within radius bits of band, band first
+    '''
+    for count in range(radius + 1):
+        for bits in combinations(range(BAND_BITS), count):
+            value = band
+            for bit in bits:
+                value ^= 1 << bit
+            yield value
+
+
+class HashIndex(object):
+    '''
+    Multi-index hashing of dHashes in memory. Searching looks up the
+    neighbours of each band of a hash in a table per band, and only
+    measures the distance to the hashes found there.
+    '''
+    def __init__(self):
+        self.tables = [{} for i in range(BANDS)]
+
+    def add(self, key, value):
+        for table, band in zip(self.tables, bands(value)):
+            table.setdefault(band, []).append((key, value))
+
+    def search(self, value, max_distance):
+        '''
+        (key, distance) of the hashes within max_distance of value, the
+        nearest first
+        '''
+        found = {}
+        for table, band in zip(self.tables, bands(value)):
+            for neighbour in neighbours(band, max_distance // BANDS):
+                for key, other in table.get(neighbour, ()):
+                    if key not in found:
+                        found[key] = distance(value, other)
+        return sorted(((key, d) for key, d in found.items()
+                       if d <= max_distance), key=lambda item: item[1])
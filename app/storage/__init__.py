@@ -0,0 +1,156 @@
+import os
+import threading
+from flask import current_app
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Storage(object):
+    '''
+    Interface of the stores that keep the photos. Files are addressed by
+    keys, relative paths separated by slashes. Reading a key that is not
+    stored raises IOError with errno ENOENT.
+    '''
+    def put(self, key, f):
+        '''
+        Store the contents of the file object f under key
+        '''
+        raise NotImplementedError()
+
+    def put_file(self, key, path):
+        '''
+        Store the local file path under key and remove path
+        '''
+        with open(path, 'rb') as f:
+            self.put(key, f)
+        os.remove(path)
+
+    def stream(self, key):
+        '''
+        Iterator over the contents of key, in chunks
+        '''
+        raise NotImplementedError()
+
+    def get(self, key):
+        return b''.join(self.stream(key))
+
+    def fetch(self, key, path):
+        '''
+        Copy the contents of key to the local file path
+        '''
+        with open(path, 'wb') as f:
+            for chunk in self.stream(key):
+                f.write(chunk)
+
+    def exists(self, key):
+        raise NotImplementedError()
+
+    def modified(self, key):
+        '''
+        Modification time of key in seconds since the epoch, None when it
+        is not stored
+        '''
+        raise NotImplementedError()
+
+    def touch(self, key):
+        '''
+        Set the modification time of key to now, which spares it from
+        cleanups that only remove files left alone for a while. Returns
+        False when key is not stored.
+        '''
+        raise NotImplementedError()
+
+    def delete(self, key):
+        '''
+        Remove key, which may already be gone
+        '''
+        raise NotImplementedError()
+
+    def delete_many(self, keys):
+        '''
+        Remove keys, which may already be gone, in as few requests as the
+        storage allows
+        '''
+        for key in keys:
+            self.delete(key)
+
+    def iter_files(self):
+        '''
+        Iterator over the (name, key, mtime) tuples of the stored files,
+        ordered by name and listed as they are read. Temporary files,
+        whose names start with a dot, may come first in any order.
+        '''
+        raise NotImplementedError()
+
+    def url(self, key):
+        '''
+        URL clients can download key from
+        '''
+        raise NotImplementedError()
+
+    def send(self, key, make_etag, max_age=None):
+        '''
+        Response serving key to the current request, see
+        app.sendfile.send_stored_file for the arguments
+        '''
+        raise NotImplementedError()
+
+    def local_path(self, key):
+        '''
+        Path of key on the local file system, None when it is not stored
+        there
+        '''
+        return None
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def storage_settings(config):
+    '''
+    The storage settings of an application config, in a form that can be
+    handed to worker processes
+    '''
+    settings = dict((name[4:].lower(), value)
+                    for name, value in config.items()
+                    if name.startswith('APP_S3_'))
+    settings['driver'] = config['APP_STORAGE']
+    settings['root'] = config['UPLOADS_DIR']
+    return settings
+
+
+def open_storage(settings):
+    '''
+    The storage described by settings, created once per process since
+    the connections of the S3 driver cannot be shared with forked ones
+    '''
+    key = (os.getpid(),) + tuple(sorted(settings.items()))
+    storage = _storages.get(key)
+    if storage is None:
+        with _storages_lock:
+            storage = _storages.get(key)
+            if storage is None:
+                storage = _storages[key] = _create(settings)
+    return storage
+
+
+def _create(settings):
+    driver = settings['driver']
+    if driver == 'local':
+        from .local import LocalStorage
+        return LocalStorage(settings['root'])
+    if driver == 's3':
+        from .s3 import S3Storage
+        return S3Storage(**dict((name[3:], value)
+                                for name, value in settings.items()
+                                if name.startswith('s3_')))
+    raise ValueError('unknown storage driver %s' % driver)
+
+
+def get_storage():
+    '''
+    The storage of the photos of the current application, selected by
+    APP_STORAGE
+    '''
+    return open_storage(storage_settings(current_app.config))
@@ -0,0 +1,185 @@
+import errno
+import itertools
+import os
+import posixpath
+import shutil
+import tempfile
+from flask import url_for
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir  # backport for Python 2
+from ..sendfile import send_stored_file
+from . import Storage, CHUNK_SIZE
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _chunks(f):
+    try:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield chunk
+    finally:
+        f.close()
+
+
+class LocalStorage(Storage):
+    '''
+    Files of the directory root, at the paths of their keys. Files of the
+    flat layout of older versions, directly in root, are found too until
+    they are moved to their keys.
+    '''
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def find(self, key):
+        '''
+        Path of key relative to root, None when it is not stored
+        '''
+        for path in (key, posixpath.basename(key)):
+            if os.path.isfile(self.path(path)):
+                return path
+        return None
+
+    def local_path(self, key):
+        path = self.find(key)
+        return path and self.path(path)
+
+    def put(self, key, f):
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(f, out, CHUNK_SIZE)
+        except:
+            _remove(tmp)
+            raise
+        self.put_file(key, tmp)
+
+    def put_file(self, key, path):
+        target = self.path(key)
+        _makedirs(os.path.dirname(target))
+        os.rename(path, target)
+
+    def stream(self, key):
+        path = self.local_path(key)
+        if path is None:
+            raise IOError(errno.ENOENT, 'not stored', key)
+        return _chunks(open(path, 'rb'))
+
+    def exists(self, key):
+        return self.find(key) is not None
+
+    def modified(self, key):
+        path = self.local_path(key)
+        try:
+            return path and os.stat(path).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def touch(self, key):
+        path = self.local_path(key)
+        if path is None:
+            return False
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def delete(self, key):
+        _remove(self.path(key))
+        _remove(self.path(posixpath.basename(key)))
+
+    def _stat(self, name, key):
+        try:
+            return [(name, key, os.stat(self.path(key)).st_mtime)]
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def _directories(self, path):
+        directory = self.path(path) if path else self.root
+        return sorted(entry.name for entry in scandir(directory)
+                      if entry.is_dir())
+
+    def _sharded_files(self):
+        for first in self._directories(''):
+            for second in self._directories(first):
+                shard = posixpath.join(first, second)
+                for name in sorted(os.listdir(self.path(shard))):
+                    key = posixpath.join(shard, name)
+                    for item in self._stat(name, key):
+                        yield item
+
+    def _temporary_files(self):
+        for entry in scandir(self.root):
+            if entry.name.startswith('.') and entry.is_file():
+                for item in self._stat(entry.name, entry.name):
+                    yield item
+
+    def iter_files(self):
+        '''
+        Files of the sharded layout, after the temporary files of
+        interrupted writes, which are not in order. Each shard is listed
+        and sorted at a time, the root directory is only read as it goes.
+
+        Files of the flat layout would have to be sorted all at once, so
+        RuntimeError is raised while there are any: run shard_uploads
+        first.
+        '''
+        if not os.path.isdir(self.root):
+            return iter(())
+        if next(self.flat_files(), None) is not None:
+            raise RuntimeError('%s still has files of the flat layout, '
+                               'run shard_uploads first' % self.root)
+        return itertools.chain(self._temporary_files(),
+                               self._sharded_files())
+
+    def url(self, key):
+        return url_for('main.uploaded_photos',
+                       filename=posixpath.basename(key), _external=True)
+
+    def send(self, key, make_etag, max_age=None):
+        return send_stored_file(self.root, self.find(key) or key,
+                                make_etag, max_age)
+
+    def flat_files(self):
+        '''
+        Iterator over the names of the files still in the flat layout,
+        read from the directory as they are needed
+        '''
+        for entry in scandir(self.root):
+            if not entry.name.startswith('.') and entry.is_file():
+                yield entry.name
+
+    def move(self, name, key):
+        '''
+        Move the file name of the flat layout to key, only removing it
+        when key was stored again in the meantime
+        '''
+        if os.path.exists(self.path(key)):
+            _remove(self.path(name))
+        else:
+            self.put_file(key, self.path(name))
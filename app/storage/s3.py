@@ -0,0 +1,148 @@
+import calendar
+import errno
+import mimetypes
+import posixpath
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from flask import redirect
+from ..sendfile import IMMUTABLE
+from . import Storage, CHUNK_SIZE
+
+
+def _chunks(body):
+    try:
+        for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+            yield chunk
+    finally:
+        body.close()
+
+
+class S3Storage(Storage):
+    '''
+    Objects of an S3 bucket, or of any store with the S3 API such as
+    MinIO at endpoint_url, under prefix followed by their keys.
+
+    The client keeps a pool of up to max_connections connections. Files
+    larger than multipart_threshold bytes are uploaded in parts of
+    multipart_chunksize bytes. Photos are served by redirecting to URLs
+    presigned for url_expiration seconds.
+    '''
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None,
+                 access_key=None, secret_key=None, max_connections=10,
+                 multipart_threshold=8 * 1024 * 1024,
+                 multipart_chunksize=8 * 1024 * 1024, url_expiration=3600):
+        self.bucket = bucket
+        self.prefix = prefix or ''
+        self.url_expiration = url_expiration
+        session = boto3.session.Session(aws_access_key_id=access_key,
+                                        aws_secret_access_key=secret_key,
+                                        region_name=region)
+        self.client = session.client(
+            's3', endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=max_connections,
+                          signature_version='s3v4'))
+        self.transfer = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_connections)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def put(self, key, f):
+        self.client.upload_fileobj(f, self.bucket, self._key(key),
+                                   ExtraArgs=self._extra_args(key),
+                                   Config=self.transfer)
+
+    def stream(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket,
+                                              Key=self._key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise IOError(errno.ENOENT, 'not stored', key)
+            raise
+        return _chunks(response['Body'])
+
+    def _extra_args(self, key):
+        return {
+            'ContentType': mimetypes.guess_type(key)[0] or
+            'application/octet-stream',
+            'CacheControl': IMMUTABLE
+        }
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket,
+                                           Key=self._key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def modified(self, key):
+        head = self._head(key)
+        return head and calendar.timegm(head['LastModified'].utctimetuple())
+
+    def touch(self, key):
+        # objects cannot be changed, but copied onto themselves with new
+        # metadata
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket, Key=self._key(key),
+                CopySource={'Bucket': self.bucket, 'Key': self._key(key)},
+                MetadataDirective='REPLACE', **self._extra_args(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def delete_many(self, keys):
+        # a request deletes up to 1000 objects
+        for i in range(0, len(keys), 1000):
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self._key(key)}
+                            for key in keys[i:i + 1000]],
+                'Quiet': True
+            })
+            # some stores report the keys that are already gone, without
+            # an error code
+            for error in response.get('Errors', ()):
+                if error.get('Code', 'NoSuchKey') != 'NoSuchKey':
+                    raise IOError('deleting %s failed: %s' % (
+                        error['Key'], error.get('Message')))
+
+    def iter_files(self):
+        # objects are listed in the order of their keys, and keys start
+        # with the shard of the name
+        pages = self.client.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=self.prefix)
+        for page in pages:
+            for item in page.get('Contents', ()):
+                key = item['Key'][len(self.prefix):]
+                yield (posixpath.basename(key), key,
+                       calendar.timegm(item['LastModified'].utctimetuple()))
+
+    def url(self, key):
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': self._key(key)
+        }, ExpiresIn=self.url_expiration)
+
+    def send(self, key, make_etag, max_age=None):
+        # the URL is kept by clients for half of its lifetime at most
+        response = redirect(self.url(key))
+        response.cache_control.private = True
+        response.cache_control.max_age = min(
+            self.url_expiration // 2,
+            self.url_expiration if max_age is None else max_age)
+        return response
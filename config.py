@@ -14,15 +14,65 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     APP_MAIL_SUBJECT_PREFIX = '[Flask Photo App]'
     APP_MAIL_SENDER = 'App Admin <admin@example.com>'
+    APP_MAIL_RETRY_DELAY = 30 # Doubled after each failed attempt
+    APP_MAIL_MAX_ATTEMPTS = 10
+    APP_MAIL_LEASE = 300 # Seconds a dispatcher owns the emails it sends
+    APP_BASE_URL = os.environ.get('APP_BASE_URL') or 'http://localhost:5000'
     APP_ADMIN = os.environ.get('APP_ADMIN')
     APP_POSTS_PER_PAGE = 20
     APP_FOLLOWERS_PER_PAGE = 50
     APP_COMMENTS_PER_PAGE = 30
     APP_SLOW_DB_QUERY_TIME = 0.5
+    APP_TIMELINE_FANOUT_LIMIT = 1000 # Followers above which posts are pulled
+    APP_TIMELINE_BACKFILL = 1000 # Posts copied into a timeline on follow
     ADMIN_ITEMS_PER_PAGE = 20
+    APP_COUNT_FREE_PAGINATION = True
+    APP_COUNT_CACHE_TTL = 300
+    APP_URL_TEMPLATES = True
+    APP_BATCH_MAX_REQUESTS = 50
+    APP_TOKEN_CACHE_SIZE = 4096 # Verified API tokens
+    APP_TOKEN_CACHE_TTL = 3600
+    APP_IDENTITY_CACHE_SIZE = 1024 # Users and roles of authenticated requests
+    APP_IDENTITY_CACHE_TTL = 60
+    APP_ROLE_CACHE_SIZE = 1
+    APP_ROLE_CACHE_TTL = 300
+    APP_CREDENTIALS_CACHE_SIZE = 1024 # Verified email and password pairs
+    APP_CREDENTIALS_CACHE_TTL = 300
+    APP_STORED_CACHE_SIZE = 16384 # Existence of thumbnails and versions
+    APP_STORED_CACHE_TTL = 3600
+    APP_PASSWORD_HASH_WORKERS = 4 # Password hash checks run at once
+    APP_AUTH_TOKEN_EXPIRATION = 3600
+    APP_LAST_SEEN_THRESHOLD = 60 # Age at which last_seen is rewritten
+    APP_PRESENCE_FLUSH_INTERVAL = 60
     UPLOADS_DIR = os.path.join(basedir, 'app', 'uploads')
+    # Let the web server send the photos: 'x-sendfile' or 'x-accel-redirect'
+    APP_SENDFILE = os.environ.get('APP_SENDFILE')
+    APP_SENDFILE_PREFIX = '/uploads/' # Internal location of X-Accel-Redirect
+    APP_PHOTO_FALLBACK_MAX_AGE = 60 # Seconds photos are cached as thumbnails
+    APP_STORAGE = os.environ.get('APP_STORAGE') or 'local' # or 's3'
+    APP_S3_BUCKET = os.environ.get('APP_S3_BUCKET')
+    APP_S3_PREFIX = os.environ.get('APP_S3_PREFIX') or ''
+    APP_S3_ENDPOINT_URL = os.environ.get('APP_S3_ENDPOINT_URL') # e.g. MinIO
+    APP_S3_REGION = os.environ.get('APP_S3_REGION')
+    APP_S3_ACCESS_KEY = os.environ.get('APP_S3_ACCESS_KEY')
+    APP_S3_SECRET_KEY = os.environ.get('APP_S3_SECRET_KEY')
+    APP_S3_MAX_CONNECTIONS = 10
+    APP_S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    APP_S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    APP_S3_URL_EXPIRATION = 3600 # Seconds presigned photo URLs are valid
+    APP_PHOTO_DELETE_DELAY = 5 # Seconds photos of deleted posts are kept
+    APP_GC_GRACE = 3600 # Age below which unused files are kept by gc_uploads
     ALLOWED_EXTENSIONS = {'jpg', 'jpe', 'jpeg', 'png', 'gif', 'svg', 'bmp'}
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024 # Max uploads 16 MB
+    APP_THUMBNAIL_SIZES = (160, 480, 1080) # Pixels of the longest side
+    APP_THUMBNAIL_QUALITY = 85
+    APP_THUMBNAIL_WORKERS = 2
+    APP_DUPLICATE_DISTANCE = 6 # Bits the dHashes of near duplicates differ in
+    # Quality of the versions of photos (None) and thumbnails by size
+    APP_TRANSCODE_QUALITY = {
+        '.webp': {None: 85, 1080: 80, 480: 75, 160: 70},
+        '.avif': {None: 70, 1080: 63, 480: 58, 160: 50}
+    }
     ASSETS_DEBUG = False
     ASSETS_BUNDLES = {'site_css':{'files': ('site.css',),
                                   'filters': 'cssmin'},
@@ -47,6 +97,7 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
     WTF_CSRF_ENABLED = False
+    APP_PHOTO_DELETE_DELAY = 0
 
 
 class ProductionConfig(Config):
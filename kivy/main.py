@@ -1,13 +1,22 @@
 import os
+import time
 from base64 import b64encode
 from kivy.app import App
 from kivy.network.urlrequest import UrlRequest
-from kivy.properties import ObjectProperty
+from kivy.properties import ObjectProperty, ListProperty
 from kivy.storage.jsonstore import JsonStore
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.screenmanager import ScreenManager, Screen
+from kivy.utils import get_color_from_hex
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
 
 class UserCred(object):
     data_dir = App().user_data_dir
@@ -18,6 +27,27 @@ class UserCred(object):
         UserCred.store.put('credentials',
                            email=email,
                            password=password)
+        if UserCred.store.exists('token'):
+            UserCred.store.delete('token')
+
+    @staticmethod
+    def store_token(token, expiration):
+        '''
+        Keep the token the server hands out, it is used instead of the
+        password until shortly before it expires
+        '''
+        UserCred.store.put('token', token=token,
+                           expires=time.time() + expiration - 60)
+
+    @staticmethod
+    def load_token():
+        try:
+            token = UserCred.store.get('token')
+        except KeyError:
+            return None
+        if token['expires'] < time.time():
+            return None
+        return token['token']
 
     @staticmethod
     def load_cred():
@@ -36,22 +66,46 @@ class UserCred(object):
 class WebApi(object):
     
     url = 'http://127.0.0.1:5000/api/v1.0/'
-    url_posts = url + 'posts/'
+    url_posts = url + 'posts/?fields=img_url,thumbnails,img_color,body'
     
     @staticmethod
     def _get_headers():
-        email, pw = UserCred.load_cred()
+        token = UserCred.load_token()
+        if token:
+            email, pw = token, ''
+        else:
+            email, pw = UserCred.load_cred()
         return {
             'Authorization': 'Basic ' + b64encode(
                 (email + ':' + pw).encode('utf-8')).decode('utf-8'),
-            'Accept': 'application/json',
+            # Ask for the more compact binary encoding when we can read it
+            'Accept': MSGPACK_MIMETYPE if msgpack else 'application/json',
             'Content-Type': 'application/json'
         }
-        
+
+    @staticmethod
+    def _decoded(callback):
+        '''
+        Wrap an on_success callback, keeping the auth token the server
+        sends and decoding MessagePack responses which UrlRequest hands
+        over as raw bytes
+        '''
+        def on_success(req, result):
+            headers = dict((k.lower(), v)
+                           for k, v in (req.resp_headers or {}).items())
+            if 'x-auth-token' in headers:
+                UserCred.store_token(
+                    headers['x-auth-token'],
+                    int(headers.get('x-auth-token-expiration', 3600)))
+            if headers.get('content-type', '').startswith(MSGPACK_MIMETYPE):
+                result = msgpack.unpackb(result, raw=False)
+            callback(req, result)
+        return on_success
+
     @staticmethod
     def posts(on_success, on_failure, on_error):
         req = UrlRequest(WebApi.url_posts,
-                         on_success=on_success,
+                         on_success=WebApi._decoded(on_success),
                          on_failure=on_failure,
                          on_error=on_error,
                          req_headers=WebApi._get_headers())
@@ -63,8 +117,13 @@ class LoginScreen(Screen):
         self.manager.current = "posts"
 
 class PostWidget(BoxLayout):
-    def __init__(self, img_src, post_text, *args, **kwargs):
+    # Shown behind the photo while it downloads
+    placeholder = ListProperty([0, 0, 0, 0])
+
+    def __init__(self, img_src, post_text, img_color=None, *args, **kwargs):
         super(PostWidget, self).__init__(*args, **kwargs)
+        if img_color:
+            self.placeholder = get_color_from_hex(img_color)
         if img_src:
             self.post_image.source = img_src
         else:
@@ -82,7 +141,9 @@ class PostCarouselScreen(Screen):
     def load_posts(self):
         def populate_posts(req, results):
             for post in results['posts']:
-                post_widget = PostWidget(post['img_url'], post['body'])
+                img_url = post['thumbnails'].get('1080', post['img_url'])
+                post_widget = PostWidget(img_url, post['body'],
+                                         post.get('img_color'))
                 self.carousel.add_widget(post_widget)
 
         def show_login_screen(req, results):
@@ -14,7 +14,8 @@ if os.path.exists('.env'):
             os.environ[var[0]] = var[1]
 
 from app import create_app, db
-from app.models import User, Follow, Role, Permission, Post, Comment
+from app.models import User, Follow, Role, Permission, Post, Comment, \
+    Timeline, OutboxEmail
 from flask.ext.script import Manager, Shell
 from flask.ext.migrate import Migrate, MigrateCommand
 
@@ -25,7 +26,8 @@ migrate = Migrate(app, db)
 
 def make_shell_context():
     return dict(app=app, db=db, User=User, Follow=Follow, Role=Role,
-                Permission=Permission, Post=Post, Comment=Comment)
+                Permission=Permission, Post=Post, Comment=Comment,
+                Timeline=Timeline, OutboxEmail=OutboxEmail)
 manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
 
@@ -61,6 +63,184 @@ def profile(length=25, profile_dir=None):
     app.run()
 
 
+@manager.command
+def rebuild_timelines():
+    """Rebuild the materialized home timelines from scratch."""
+    Timeline.rebuild()
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', default=1000,
+                type=int, help='Rows updated per transaction')
+def repair_counters(batch_size):
+    """Recompute the post, comment and follower counters."""
+    from app.models import repair_counters
+    print('Repaired %d rows' % repair_counters(batch_size))
+
+
+@manager.option('-n', '--count', dest='count', default=100, type=int,
+                help='Posts serialized per round')
+@manager.option('-r', '--rounds', dest='rounds', default=50, type=int,
+                help='Rounds timed for each mode')
+def benchmark_json(count, rounds):
+    """Measure to_json throughput with and without URL templates."""
+    import time
+    from datetime import datetime
+    from flask import g
+    posts = [Post(id=i, body='post %d' % i, imagefile='%024x.jpg' % i,
+                  author_id=i, comment_count=0, timestamp=datetime.utcnow())
+             for i in range(1, count + 1)]
+    results = {}
+    with app.test_request_context():
+        for templates in (False, True):
+            app.config['APP_URL_TEMPLATES'] = templates
+            g._url_templates = {}
+            start = time.time()
+            for i in range(rounds):
+                results[templates] = [post.to_json() for post in posts]
+            elapsed = time.time() - start
+            print('%-14s %10.0f items/second' % (
+                'url templates:' if templates else 'url_for:',
+                count * rounds / elapsed))
+    if results[False] != results[True]:
+        print('Serialized posts differ between the two modes!')
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', default=100,
+                type=int, help='Emails sent per SMTP connection')
+@manager.option('-l', '--loop', dest='loop', action='store_true',
+                default=False, help='Keep polling the outbox')
+@manager.option('-i', '--interval', dest='interval', default=5, type=float,
+                help='Seconds between polls of the outbox')
+def dispatch_email(batch_size, loop, interval):
+    """Send the emails waiting in the outbox."""
+    import time
+    from app.email import dispatch_outbox
+    while True:
+        sent, failed = dispatch_outbox(batch_size)
+        if sent or failed:
+            print('Sent %d emails, %d failed' % (sent, failed))
+        if not loop:
+            break
+        time.sleep(interval)
+
+
+@manager.option('-f', '--force', dest='force', action='store_true',
+                default=False, help='Rewrite the existing thumbnails')
+def thumbnails(force):
+    """Make the missing thumbnails of the stored photos."""
+    from app.photos import has_thumbnails, thumbnail_args, \
+        thumbnail_pool, thumbnail_job
+    names = [name for name, in db.session.query(Post.imagefile).distinct()
+             if name and has_thumbnails(name)]
+    made = failed = 0
+    for name, result in thumbnail_pool().imap_unordered(
+            thumbnail_job, [thumbnail_args(name, force) for name in names]):
+        if isinstance(result, Exception):
+            failed += 1
+            print('%s: %s' % (name, result))
+        else:
+            made += len(result)
+    print('Made %d thumbnails of %d photos, %d failed' % (
+        made, len(names), failed))
+
+
+@manager.option('-f', '--force', dest='force', action='store_true',
+                default=False, help='Analyze photos analyzed before too')
+def photo_metadata(force):
+    """Store the size, color and hashes of the photos of the posts."""
+    from app.photos import has_thumbnails, metadata_job, thumbnail_pool
+    from app.storage import storage_settings
+    query = db.session.query(Post.imagefile).distinct()
+    if not force:
+        query = query.filter(Post.photo_dhash == None)
+    names = [name for name, in query if name and has_thumbnails(name)]
+    settings = storage_settings(app.config)
+    stored = failed = 0
+    for name, result in thumbnail_pool().imap_unordered(
+            metadata_job, [(settings, name) for name in names]):
+        if isinstance(result, Exception):
+            failed += 1
+            print('%s: %s' % (name, result))
+        else:
+            Post.set_photo_metadata(name, result)
+            stored += 1
+    print('Analyzed %d of %d photos, %d failed' % (
+        stored, len(names), failed))
+
+
+@manager.option('-d', '--distance', dest='distance', default=None, type=int,
+                help='Bits the dHashes of near duplicates differ in')
+def duplicates(distance):
+    """List the groups of near duplicate photos of the library."""
+    from app.similarity import HashIndex
+    if distance is None:
+        distance = app.config['APP_DUPLICATE_DISTANCE']
+    index = HashIndex()
+    # each photo is compared to the ones before it, and joins the group
+    # of the nearest one it duplicates
+    leaders = {}
+    groups = {}
+    query = db.session.query(Post.imagefile, Post.photo_dhash) \
+        .filter(Post.photo_dhash != None).distinct() \
+        .execution_options(stream_results=True).yield_per(1000)
+    for name, dhash in query:
+        dhash = int(dhash, 16)
+        found = index.search(dhash, distance)
+        leaders[name] = leaders[found[0][0]] if found else name
+        if found:
+            groups.setdefault(leaders[name], []).append(name)
+        index.add(name, dhash)
+    for leader, group in sorted(groups.items()):
+        print(' '.join([leader] + group))
+    print('Found %d near duplicates among %d photos' % (
+        sum(len(group) for group in groups.values()), len(leaders)))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', default=1000,
+                type=int, help='Files moved between pauses')
+@manager.option('-p', '--pause', dest='pause', default=0, type=float,
+                help='Seconds to wait between batches')
+def shard_uploads(batch_size, pause):
+    """Move the photos of the flat uploads directory to their shards."""
+    import time
+    from app.photos import storage_path
+    from app.storage import get_storage
+    from app.storage.local import LocalStorage
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        print('Only local storages have a flat layout')
+        return
+    # files are moved as the directory is read, which holds no listing
+    # of it in memory
+    moved = 0
+    for name in storage.flat_files():
+        storage.move(name, storage_path(name))
+        moved += 1
+        if moved % batch_size == 0:
+            print('Moved %d files' % moved)
+            time.sleep(pause)
+    print('Moved %d files' % moved)
+
+
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true',
+                default=False, help='Only list the files')
+@manager.option('-g', '--grace', dest='grace', default=None, type=int,
+                help='Age in seconds below which files are kept')
+def gc_uploads(dry_run, grace):
+    """Remove the stored photos that no post uses."""
+    from app.photos import collect_garbage
+    if grace is None:
+        grace = app.config['APP_GC_GRACE']
+    count = 0
+    try:
+        for key in collect_garbage(grace, dry_run):
+            print(key)
+            count += 1
+    except RuntimeError as e:
+        print(e)
+    print('%s %d files' % ('Found' if dry_run else 'Removed', count))
+
+
 @manager.command
 def deploy():
     """Run deployment tasks."""
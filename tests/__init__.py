@@ -0,0 +1,27 @@
+import os
+from contextlib import contextmanager
+from flask.ext.sqlalchemy import get_debug_queries
+
+
+class QueryCountMixin(object):
+    @contextmanager
+    def assertMaxQueries(self, count):
+        '''
+        Fail if the code in the block issues more than count SQL queries
+        '''
+        start = len(get_debug_queries())
+        yield
+        queries = get_debug_queries()[start:]
+        self.assertTrue(
+            len(queries) <= count,
+            '%d queries issued, expected at most %d:\n%s' % (
+                len(queries), count,
+                '\n'.join(query.statement for query in queries)))
+
+
+def stored_files(directory):
+    '''
+    Sorted names of the files under directory, at any depth
+    '''
+    return sorted(name for path, dirs, names in os.walk(directory)
+                  for name in names)
@@ -3,10 +3,14 @@ import json
 import re
 from base64 import b64encode
 from flask import url_for
+from werkzeug.urls import url_parse
 from app import create_app, db
 from app.models import User, Role, Post, Comment
+from app.api_1_0.responses import msgpack
+from app.cache import get_cache
+from . import QueryCountMixin
 
-class APITestCase(unittest.TestCase):
+class APITestCase(QueryCountMixin, unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')
         self.app_context = self.app.app_context()
@@ -28,6 +32,10 @@ class APITestCase(unittest.TestCase):
             'Content-Type': 'application/json'
         }
 
+    def relative_url(self, url):
+        # the test client drops the query string of absolute URLs
+        return url_parse(url).replace(scheme='', netloc='').to_url()
+
     def test_404(self):
         response = self.client.get(
             '/wrong/url',
@@ -86,6 +94,52 @@ class APITestCase(unittest.TestCase):
             headers=self.get_api_headers(token, ''))
         self.assertTrue(response.status_code == 200)
 
+    def test_credentials_cache(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+        credentials = get_cache('credentials')
+
+        # the password hash is only checked the first time
+        for i in range(3):
+            response = self.client.get(
+                url_for('api.get_posts'),
+                headers=self.get_api_headers('john@example.com', 'cat'))
+            self.assertTrue(response.status_code == 200)
+        self.assertTrue(credentials.misses == 1 and credentials.hits == 2)
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertTrue(response.status_code == 401)
+        self.assertFalse('X-Auth-Token' in response.headers)
+
+        # password authentication hands out a token
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        token = response.headers['X-Auth-Token']
+        self.assertTrue(response.headers['X-Auth-Token-Expiration'] ==
+                        '3600')
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers(token, ''))
+        self.assertTrue(response.status_code == 200)
+        self.assertFalse('X-Auth-Token' in response.headers)
+
+        # a new password invalidates the cached credentials
+        u.password = 'dog'
+        db.session.commit()
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertTrue(response.status_code == 401)
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertTrue(response.status_code == 200)
+
     def test_anonymous(self):
         response = self.client.get(
             url_for('api.get_posts'),
@@ -160,6 +214,222 @@ class APITestCase(unittest.TestCase):
         self.assertTrue(json_response['body'] == 'updated body')
         self.assertTrue(json_response['body_html'] == '<p>updated body</p>')
 
+    def test_cursor_pagination(self):
+        # add a user with five posts
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=r)
+        db.session.add(u)
+        db.session.commit()
+        for i in range(5):
+            db.session.add(Post(body='post %d' % i, author=u))
+        db.session.commit()
+        self.app.config['APP_POSTS_PER_PAGE'] = 2
+
+        # walk forward through the pages
+        bodies = []
+        url = url_for('api.get_posts', cursor='')
+        while url:
+            response = self.client.get(
+                self.relative_url(url),
+                headers=self.get_api_headers('john@example.com', 'cat'))
+            self.assertTrue(response.status_code == 200)
+            json_response = json.loads(response.data.decode('utf-8'))
+            self.assertFalse('count' in json_response)
+            bodies.extend(p['body'] for p in json_response['posts'])
+            last_page = json_response
+            url = json_response['next']
+        self.assertEqual(bodies, ['post %d' % i for i in range(4, -1, -1)])
+        self.assertIsNone(last_page['next_cursor'])
+
+        # and back again from the last page
+        response = self.client.get(
+            self.relative_url(last_page['prev']),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([p['body'] for p in json_response['posts']],
+                         ['post 2', 'post 1'])
+
+        # page based links still work
+        response = self.client.get(
+            self.relative_url(url_for('api.get_user_posts', id=u.id, page=2)),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(json_response['count'] == 5)
+        self.assertTrue('/users/%d/posts/?page=3' % u.id in
+                        json_response['next'])
+
+        # malformed cursors are rejected
+        response = self.client.get(
+            self.relative_url(url_for('api.get_posts', cursor='bogus')),
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertTrue(response.status_code == 400)
+
+    def test_url_templates(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        posts = [Post(body='post', imagefile='0123456789abcdef.jpg', author=u),
+                 Post(body='post', imagefile='photo name.jpg', author=u)]
+        comment = Comment(body='comment', author=u, post=posts[0])
+        db.session.add_all(posts + [u, comment])
+        db.session.commit()
+        objects = [u, comment] + posts
+
+        with self.app.test_request_context(
+                '/', base_url='https://example.com/photos/'):
+            self.app.config['APP_URL_TEMPLATES'] = False
+            expected = [o.to_json() for o in objects]
+            self.app.config['APP_URL_TEMPLATES'] = True
+            self.assertEqual([o.to_json() for o in objects], expected)
+            self.assertEqual([o.to_json() for o in objects], expected)
+        self.assertTrue(expected[2]['url'].startswith('https://'))
+        self.assertTrue('/photos/api/v1.0/posts/' in expected[2]['url'])
+        self.assertTrue(expected[3]['img_url'].endswith(
+            '/photos/photo%20name.jpg'))
+
+    def test_compact_json(self):
+        response = self.client.get(
+            url_for('api.get_posts'),
+            headers=self.get_api_headers('', ''))
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.content_type == 'application/json')
+        self.assertFalse(b'\n' in response.data)
+        self.assertFalse(b', ' in response.data)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+        headers['Accept'] = 'application/msgpack'
+        response = self.client.get(url_for('api.get_user', id=u.id),
+                                   headers=headers)
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.content_type == 'application/msgpack')
+        msgpack_response = msgpack.unpackb(response.data, raw=False)
+        headers['Accept'] = 'application/json'
+        response = self.client.get(url_for('api.get_user', id=u.id),
+                                   headers=headers)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(msgpack_response, json_response)
+
+        # errors are negotiated too
+        headers['Accept'] = 'application/msgpack'
+        response = self.client.post(url_for('api.new_post'),
+                                    headers=headers,
+                                    data=json.dumps({'body': ''}))
+        self.assertTrue(response.status_code == 400)
+        self.assertEqual(msgpack.unpackb(response.data, raw=False)['error'],
+                         'bad request')
+
+    def test_sparse_fields_and_expand(self):
+        r = Role.query.filter_by(name='User').first()
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat', confirmed=True, role=r)
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.add_all(Post(body='post %d' % i, author=users[i % 3])
+                           for i in range(6))
+        db.session.commit()
+        db.session.expunge_all()
+
+        # only the requested attributes
+        response = self.client.get(
+            self.relative_url(url_for('api.get_posts',
+                                      fields='img_url,body')),
+            headers=self.get_api_headers('', ''))
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(len(json_response['posts']) == 6)
+        for post in json_response['posts']:
+            self.assertEqual(set(post), set(['img_url', 'body']))
+
+        # authors are embedded, fetched in one query for the whole page
+        with self.assertMaxQueries(2):
+            response = self.client.get(
+                self.relative_url(url_for('api.get_posts',
+                                          fields='body,author',
+                                          expand='author', cursor='')),
+                headers=self.get_api_headers('', ''))
+        self.assertTrue(response.status_code == 200)
+        json_response = json.loads(response.data.decode('utf-8'))
+        for post in json_response['posts']:
+            self.assertEqual(set(post), set(['body', 'author']))
+            self.assertEqual(post['author']['username'],
+                             'user%d' % (int(post['body'].split()[1]) % 3))
+
+        # single resources and unknown expansions
+        post = Post.query.first()
+        response = self.client.get(
+            self.relative_url(url_for('api.get_post', id=post.id,
+                                      expand='author')),
+            headers=self.get_api_headers('', ''))
+        json_response = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(json_response['author']['username'],
+                         post.author.username)
+        response = self.client.get(
+            self.relative_url(url_for('api.get_post', id=post.id,
+                                      expand='comments')),
+            headers=self.get_api_headers('', ''))
+        self.assertTrue(response.status_code == 400)
+
+    def test_batch(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True, role=r)
+        posts = [Post(body='post %d' % i, author=u) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        post_urls = [url_for('api.get_post', id=post.id, _external=True)
+                     for post in posts]
+        user_path = self.relative_url(url_for('api.get_user', id=u.id))
+        comments_path = self.relative_url(
+            url_for('api.get_post_comments', id=posts[0].id, cursor=''))
+        requests = post_urls + [user_path, user_path, comments_path,
+                                '/api/v1.0/posts/12345',
+                                '/api/v1.0/posts?fields=body']
+        db.session.expunge_all()
+
+        # authentication, the posts and the user are one query each
+        with self.assertMaxQueries(5):
+            response = self.client.post(
+                url_for('api.batch'),
+                headers=self.get_api_headers('john@example.com', 'cat'),
+                data=json.dumps({'requests': requests}))
+        self.assertTrue(response.status_code == 200)
+        responses = json.loads(response.data.decode('utf-8'))['responses']
+        self.assertEqual([r['url'] for r in responses], requests)
+        self.assertEqual([r['status'] for r in responses],
+                         [200, 200, 200, 200, 200, 200, 404, 301])
+        self.assertEqual([r['body']['body'] for r in responses[:3]],
+                         ['post 0', 'post 1', 'post 2'])
+        self.assertEqual(responses[3]['body']['username'], 'john')
+        self.assertEqual(responses[3], dict(responses[4], url=user_path))
+        self.assertEqual(responses[5]['body']['posts'], [])
+        self.assertEqual(responses[6]['body']['error'], 'not found')
+
+        # the batch requires the same credentials as its requests
+        response = self.client.post(
+            url_for('api.batch'),
+            headers=self.get_api_headers('john@example.com', 'dog'),
+            data=json.dumps({'requests': requests}))
+        self.assertTrue(response.status_code == 401)
+
+        # and is not recursive
+        response = self.client.post(
+            url_for('api.batch'),
+            headers=self.get_api_headers('john@example.com', 'cat'),
+            data=json.dumps({'requests': ['/api/v1.0/batch', 'posts/']}))
+        self.assertTrue(response.status_code == 400)
+        response = self.client.post(
+            url_for('api.batch'),
+            headers=self.get_api_headers('john@example.com', 'cat'),
+            data=json.dumps({'requests': ['/api/v1.0/batch']}))
+        self.assertTrue(response.status_code == 200)
+        responses = json.loads(response.data.decode('utf-8'))['responses']
+        self.assertEqual(responses[0]['status'], 405)
+
     def test_users(self):
         # add two users
         r = Role.query.filter_by(name='User').first()
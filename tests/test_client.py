@@ -1,12 +1,23 @@
+import os
 import re
+import shutil
+import tempfile
 import unittest
+from io import BytesIO
 from flask import url_for
+from werkzeug.exceptions import RequestEntityTooLarge
 from app import create_app, db
-from app.models import User, Role
+from app.models import User, Role, Post, Comment, OutboxEmail
+from app.photos import PhotoUpload, storage_path, deletion_queue, photo_key
+from app.storage import get_storage
+from PIL import Image, ImageDraw
+from . import QueryCountMixin, stored_files
+from .test_similarity import make_photo
 
-class FlaskClientTestCase(unittest.TestCase):
+class FlaskClientTestCase(QueryCountMixin, unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')
+        self.uploads = self.app.config['UPLOADS_DIR'] = tempfile.mkdtemp()
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -14,14 +25,75 @@ class FlaskClientTestCase(unittest.TestCase):
         self.client = self.app.test_client(use_cookies=True)
 
     def tearDown(self):
+        deletions = self.app.extensions.get('photo_deletions')
+        if deletions is not None:
+            deletions.stop()
+        pool = self.app.extensions.get('thumbnail_pool')
+        if pool is not None:
+            pool.terminate()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        shutil.rmtree(self.uploads)
+
+    def login(self):
+        u = User(email='john@example.com', username='john',
+                 password='cat', confirmed=True)
+        db.session.add(u)
+        db.session.commit()
+        self.client.post(url_for('auth.login'), data={
+            'email': 'john@example.com',
+            'password': 'cat'
+        })
 
     def test_home_page(self):
         response = self.client.get(url_for('main.index'))
         self.assertTrue(b'Stranger' in response.data)
 
+    def test_count_free_pagination(self):
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        db.session.add(u)
+        for i in range(3):
+            db.session.add(Post(body='post %d' % i, author=u))
+        db.session.commit()
+        self.app.config['APP_POSTS_PER_PAGE'] = 2
+
+        response = self.client.get(url_for('main.index'))
+        self.assertTrue(b'Page 1 of about 2' in response.data)
+        self.assertTrue(b'/?page=2' in response.data)
+        response = self.client.get('/?page=2')
+        self.assertTrue(b'post 0' in response.data)
+        self.assertFalse(b'post 1' in response.data)
+        self.assertTrue(b'/?page=1' in response.data)
+        self.assertFalse(b'/?page=3' in response.data)
+
+    def test_listing_query_counts(self):
+        # one post and one comment from each of ten different users
+        users = [User(email='user%d@example.com' % i,
+                      username='user%d' % i, password='cat',
+                      confirmed=True) for i in range(10)]
+        db.session.add_all(users)
+        post = Post(body='post', imagefile='photo.jpg', author=users[0])
+        db.session.add(post)
+        for u in users[1:]:
+            db.session.add(Post(body='post', author=u))
+            db.session.add(Comment(body='comment', author=u, post=post))
+        db.session.commit()
+        post_id = post.id
+        db.session.expunge_all()
+
+        with self.assertMaxQueries(3):
+            response = self.client.get(url_for('main.index'))
+        self.assertTrue(response.status_code == 200)
+        with self.assertMaxQueries(3):
+            response = self.client.get(url_for('main.post', id=post_id))
+        self.assertTrue(response.status_code == 200)
+        with self.assertMaxQueries(3):
+            response = self.client.get(url_for('main.user',
+                                               username='user1'))
+        self.assertTrue(response.status_code == 200)
+
     def test_register_and_login(self):
         # register a new account
         response = self.client.post(url_for('auth.register'), data={
@@ -31,6 +103,8 @@ class FlaskClientTestCase(unittest.TestCase):
             'password2': 'cat'
         })
         self.assertTrue(response.status_code == 302)
+        self.assertTrue(OutboxEmail.query.filter_by(
+            recipient='john@example.com').count() == 1)
 
         # login with the new account
         response = self.client.post(url_for('auth.login'), data={
@@ -52,3 +126,145 @@ class FlaskClientTestCase(unittest.TestCase):
         # log out
         response = self.client.get(url_for('auth.logout'), follow_redirects=True)
         self.assertTrue(b'You have been logged out' in response.data)
+
+    def test_streamed_upload(self):
+        self.login()
+
+        # the photo is streamed to its final name
+        png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 1000
+        response = self.client.post(url_for('main.index'), data={
+            'body': 'photo',
+            'photo': (BytesIO(png), 'photo.png')
+        })
+        self.assertTrue(response.status_code == 302)
+        post = Post.query.one()
+        self.assertTrue(post.imagefile.endswith('.png'))
+        self.assertEqual(stored_files(self.uploads), [post.imagefile])
+        with open(os.path.join(
+                self.uploads, storage_path(post.imagefile)), 'rb') as f:
+            self.assertTrue(f.read() == png)
+
+        # bodies that are not images are rejected
+        response = self.client.post(url_for('main.index'), data={
+            'body': 'text',
+            'photo': (BytesIO(b'not an image' * 100), 'photo.jpg')
+        })
+        self.assertTrue(response.status_code == 415)
+        self.assertTrue(Post.query.count() == 1)
+        self.assertEqual(stored_files(self.uploads), [post.imagefile])
+
+        # and so are bodies that grow too large
+        upload = PhotoUpload(self.uploads, 10)
+        upload.write(png[:8])
+        with self.assertRaises(RequestEntityTooLarge):
+            upload.write(png[8:16])
+        self.assertEqual(stored_files(self.uploads), [post.imagefile])
+
+    def test_duplicate_upload(self):
+        self.login()
+
+        def upload(image, quality=90):
+            photo = BytesIO()
+            image.save(photo, 'JPEG', quality=quality)
+            photo.seek(0)
+            response = self.client.post(url_for('main.index'), data={
+                'body': 'photo',
+                'photo': (photo, 'photo.jpg')
+            }, follow_redirects=True)
+            return Post.query.order_by(Post.id.desc()).first(), \
+                response.get_data(as_text=True)
+
+        photo = make_photo(1)
+        first, page = upload(photo)
+        self.assertEqual((first.photo_width, first.photo_height),
+                         (800, 600))
+        self.assertTrue(first.photo_dhash is not None)
+
+        # a smaller copy of the photo is not stored again
+        copy, page = upload(photo.resize((400, 300), Image.LANCZOS),
+                            60)
+        self.assertTrue('stored copy is used' in page)
+        self.assertEqual(copy.imagefile, first.imagefile)
+        self.assertEqual(copy.photo_width, 800)
+        similar = Post.similar_photos(int(first.photo_dhash, 16), 6)
+        self.assertEqual([(p.imagefile, d) for p, d in similar],
+                         [(first.imagefile, 0)])
+
+        # edits that look like the photo are posted with a warning
+        edit = photo.copy()
+        ImageDraw.Draw(edit).rectangle((300, 200, 380, 280), 'black')
+        edited, page = upload(edit)
+        self.assertTrue('looks like the one you posted' in page)
+        self.assertNotEqual(edited.imagefile, first.imagefile)
+
+        # and other photos without one
+        other, page = upload(make_photo(2))
+        self.assertFalse('looks like' in page)
+        self.assertNotEqual(other.imagefile, first.imagefile)
+
+        pool = self.app.extensions['thumbnail_pool']
+        pool.close()
+        pool.join()
+        deletion_queue().join()
+        self.assertEqual(
+            set(photo_key(name) for name in stored_files(self.uploads)),
+            set([photo_key(first.imagefile),
+                 photo_key(edited.imagefile),
+                 photo_key(other.imagefile)]))
+
+    def test_photo_serving(self):
+        name = 'a' * 24 + '.jpg'
+        with open(os.path.join(self.uploads, name), 'wb') as f:
+            f.write(b'0123456789')
+        url = '/photos/' + name
+        response = self.client.get(url)
+        self.assertTrue(response.data == b'0123456789')
+        self.assertTrue(response.headers['ETag'] == '"%s"' % ('a' * 24))
+        self.assertTrue('immutable' in response.headers['Cache-Control'])
+        self.assertTrue(response.headers['Accept-Ranges'] == 'bytes')
+
+        # conditional and range requests
+        response = self.client.get(url, headers={
+            'If-None-Match': '"%s"' % ('a' * 24)})
+        self.assertTrue(response.status_code == 304)
+        self.assertTrue(response.data == b'')
+        response = self.client.get(url, headers={'Range': 'bytes=2-4'})
+        self.assertTrue(response.status_code == 206)
+        self.assertTrue(response.data == b'234')
+        self.assertTrue(response.headers['Content-Range'] ==
+                        'bytes 2-4/10')
+        response = self.client.get(url, headers={'Range': 'bytes=-3'})
+        self.assertTrue(response.data == b'789')
+        response = self.client.get(url, headers={'Range': 'bytes=20-'})
+        self.assertTrue(response.status_code == 416)
+        response = self.client.get(url, headers={'Range': 'bytes=2-4',
+                                                 'If-Range': '"other"'})
+        self.assertTrue(response.status_code == 200)
+        self.assertTrue(response.data == b'0123456789')
+
+        # photos standing in for missing thumbnails are not immutable
+        response = self.client.get(url + '?size=160')
+        self.assertTrue('immutable' not in
+                        response.headers['Cache-Control'])
+        self.assertTrue(response.data == b'0123456789')
+
+        # the web server can send the bytes
+        self.app.config['APP_SENDFILE'] = 'x-sendfile'
+        response = self.client.get(url)
+        self.assertTrue(response.headers['X-Sendfile'] ==
+                        os.path.join(self.uploads, name))
+        self.assertTrue(response.data == b'')
+        self.app.config['APP_SENDFILE'] = 'x-accel-redirect'
+        response = self.client.get(url)
+        self.assertTrue(response.headers['X-Accel-Redirect'] ==
+                        '/uploads/' + name)
+
+        # photos are served from either layout while they are moved
+        get_storage().move(name, storage_path(name))
+        self.assertTrue(stored_files(self.uploads) == [name])
+        self.app.config['APP_SENDFILE'] = None
+        response = self.client.get(url)
+        self.assertTrue(response.data == b'0123456789')
+
+        response = self.client.get('/photos/missing.jpg')
+        self.assertTrue(response.status_code == 404)
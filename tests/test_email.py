@@ -0,0 +1,128 @@
+import socket
+import threading
+import unittest
+from datetime import datetime
+from app import create_app, db
+from app.email import queue_email, dispatch_outbox, _claim
+from app.models import User, OutboxEmail
+
+try:
+    import asyncore
+    import smtpd
+except ImportError:
+    smtpd = None
+
+
+if smtpd is not None:
+    class RecordingSMTPServer(smtpd.SMTPServer):
+        '''
+        Local SMTP server that keeps the messages it receives and counts
+        the connections made to it
+        '''
+        def __init__(self):
+            smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+            self.port = self.socket.getsockname()[1]
+            self.messages = []
+            self.connections = 0
+
+        def handle_accept(self):
+            self.connections += 1
+            smtpd.SMTPServer.handle_accept(self)
+
+        def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+            self.messages.append((rcpttos, data))
+
+
+@unittest.skipIf(smtpd is None, 'smtpd is not available')
+class EmailTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = RecordingSMTPServer()
+        self.server_thread = threading.Thread(
+            target=asyncore.loop, kwargs={'timeout': 0.1})
+        self.server_thread.start()
+        self.app = create_app('testing')
+        state = self.app.extensions['mail']
+        state.server = 'localhost'
+        state.port = self.server.port
+        state.use_tls = False
+        state.username = None
+        state.suppress = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        self.server.close()
+        self.server_thread.join()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_outbox(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.flush()
+        for i in range(3):
+            queue_email('user%d@example.com' % i, 'Confirm Your Account',
+                        'auth/email/confirm', user=u, token='token%d' % i)
+        db.session.commit()
+        self.assertEqual(dispatch_outbox(batch_size=2), (3, 0))
+        self.assertTrue(self.server.connections == 2)
+        self.assertEqual(sorted(rcpttos for rcpttos, data
+                                in self.server.messages),
+                         [['user%d@example.com' % i] for i in range(3)])
+        self.assertTrue(b'/auth/confirm/token0' in self.server.messages[0][1])
+        self.assertTrue(OutboxEmail.query.filter(
+            OutboxEmail.sent_at == None).count() == 0)
+        self.assertEqual(dispatch_outbox(), (0, 0))
+
+    def test_outbox_retries(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.flush()
+        queue_email(u.email, 'Confirm Your Account', 'auth/email/confirm',
+                    user=u, token='token')
+        db.session.commit()
+
+        # nothing listens on the port of a closed socket
+        s = socket.socket()
+        s.bind(('localhost', 0))
+        self.app.extensions['mail'].port = s.getsockname()[1]
+        s.close()
+        self.assertEqual(dispatch_outbox(), (0, 1))
+        email = OutboxEmail.query.one()
+        self.assertTrue(email.attempts == 1 and email.last_error)
+        self.assertTrue(email.next_attempt_at > datetime.utcnow())
+        self.assertEqual(dispatch_outbox(), (0, 0))
+
+        # the next attempt waits twice as long
+        email.next_attempt_at = datetime.utcnow()
+        db.session.commit()
+        before = datetime.utcnow()
+        self.assertEqual(dispatch_outbox(), (0, 1))
+        email = OutboxEmail.query.one()
+        self.assertTrue(email.attempts == 2)
+        self.assertTrue((email.next_attempt_at - before).total_seconds() >=
+                        2 * self.app.config['APP_MAIL_RETRY_DELAY'] - 1)
+
+        # until it is sent
+        self.app.extensions['mail'].port = self.server.port
+        email.next_attempt_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(dispatch_outbox(), (1, 0))
+        self.assertTrue(len(self.server.messages) == 1)
+
+    def test_outbox_claim(self):
+        for i in range(3):
+            queue_email('user%d@example.com' % i, 'Confirm Your Account',
+                        'auth/email/confirm', token='token')
+        db.session.commit()
+        now = datetime.utcnow()
+        claimed = _claim(now, 2)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(len(set(email.claim for email in claimed)), 1)
+        # a second dispatcher at the same time only gets the rest
+        others = _claim(now, 2)
+        self.assertEqual(len(others), 1)
+        self.assertFalse(set(claimed) & set(others))
+        self.assertEqual(_claim(now, 2), [])
@@ -1,21 +1,41 @@
+import logging
 import os
+import shutil
+import time
+import tempfile
 import unittest
+from io import BytesIO
 from app import create_app, db
 from app.models import User, AnonymousUser, Role, Permission, Follow, Post, \
     Comment
+from app.photos import save_photo, generate_thumbnails, sized_photo, \
+    thumbnail_filename, remove_photo, transcode_formats, storage_path, \
+    deletion_queue, collect_garbage, extract_metadata, DeletionQueue, \
+    hash_upload
+from app.storage import get_storage
+from PIL import Image
+from . import stored_files
 
 class UserModelTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')
+        self.uploads = self.app.config['UPLOADS_DIR'] = tempfile.mkdtemp()
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
         Role.insert_roles()
 
     def tearDown(self):
+        deletions = self.app.extensions.get('photo_deletions')
+        if deletions is not None:
+            deletions.stop()
+        pool = self.app.extensions.get('thumbnail_pool')
+        if pool is not None:
+            pool.terminate()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        shutil.rmtree(self.uploads)
 
     def test_post_cascade_comments(self):
         '''
@@ -94,6 +114,7 @@ class UserModelTestCase(unittest.TestCase):
         self.assertFalse(Post.query.get(p.id) is None)
         
         p.delete()
+        deletion_queue().join()
 
         # Check that the image file doesn't exist
         self.assertFalse(os.path.isfile(fpath))
@@ -102,3 +123,226 @@ class UserModelTestCase(unittest.TestCase):
         self.assertTrue(Post.query.get(p.id) is None)
 
                      
+
+    def test_content_addressed_photos(self):
+        # identical photos are stored once, under their digest
+        name1 = save_photo(BytesIO(b'photo'), 'a.JPEG')
+        name2 = save_photo(BytesIO(b'photo'), 'b.jpg')
+        name3 = save_photo(BytesIO(b'other photo'), 'c.jpg')
+        self.assertTrue(name1 == name2)
+        self.assertTrue(name1 != name3)
+        self.assertTrue(name1.endswith('.jpg') and len(name1) <= 32)
+        self.assertEqual(stored_files(self.uploads), sorted([name1, name3]))
+        with open(os.path.join(self.uploads, storage_path(name1)), 'rb') as f:
+            self.assertTrue(f.read() == b'photo')
+
+        # and only removed with the last post that uses them
+        u = User(email='foo@foo.com', password='foo')
+        p1 = Post(body='one', imagefile=name1, author=u)
+        p2 = Post(body='two', imagefile=name2, author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertTrue(Post.photo_references(name1) == 2)
+        p1.delete()
+        deletion_queue().join()
+        self.assertTrue(stored_files(self.uploads) == sorted([name1, name3]))
+        p2.delete()
+        deletion_queue().join()
+        self.assertTrue(stored_files(self.uploads) == [name3])
+
+    def test_deferred_photo_removal(self):
+        names = [save_photo(BytesIO(b'photo %d' % i), 'photo.jpg')
+                 for i in range(3)]
+        u = User(email='foo@foo.com', password='foo')
+        posts = [Post(body='post', imagefile=name, author=u)
+                 for name in names]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        # nothing is removed when the deletion is rolled back
+        db.session.delete(posts[0])
+        db.session.flush()
+        db.session.rollback()
+        deletion_queue().join()
+        self.assertTrue(stored_files(self.uploads) == sorted(names))
+
+        # deleting a user removes the photos of their posts
+        db.session.delete(u)
+        db.session.commit()
+        deletion_queue().join()
+        self.assertTrue(stored_files(self.uploads) == [])
+
+    def test_reuploads_are_not_removed(self):
+        queue = DeletionQueue(self.app, 2)
+        self.addCleanup(queue.stop)
+        name = save_photo(BytesIO(b'photo'), 'photo.jpg')
+        day_ago = time.time() - 86400
+        os.utime(os.path.join(self.uploads, storage_path(name)),
+                 (day_ago, day_ago))
+        queue.schedule([name])
+
+        # the photo is uploaded again, and its post committed after
+        # the deletion is due
+        time.sleep(1)
+        self.assertEqual(save_photo(BytesIO(b'photo'), 'photo.jpg'),
+                         name)
+        time.sleep(1.5)
+        db.session.add(Post(body='post', imagefile=name))
+        db.session.commit()
+        queue.join()
+        self.assertEqual(stored_files(self.uploads), [name])
+        self.assertEqual(queue.removed, 0)
+
+    def test_gc_uploads(self):
+        used = save_photo(BytesIO(b'used'), 'photo.jpg')
+        unused = save_photo(BytesIO(b'unused'), 'photo.jpg')
+        stem = os.path.splitext(unused)[0]
+        storage = get_storage()
+        storage.put(storage_path(stem + '-160.jpg'), BytesIO(b'thumb'))
+        storage.put(storage_path(used.replace('.jpg', '.webp')),
+                    BytesIO(b'version'))
+        with open(os.path.join(self.uploads, '.upload-left'), 'wb') as f:
+            f.write(b'partial')
+        db.session.add(Post(body='post', imagefile=used))
+        db.session.commit()
+
+        # recent files may belong to posts being created
+        self.assertEqual(list(collect_garbage(3600)), [])
+
+        # and photos that are uploaded again are recent
+        day_ago = time.time() - 86400
+        for name in (unused, stem + '-160.jpg'):
+            os.utime(os.path.join(self.uploads, storage_path(name)),
+                     (day_ago, day_ago))
+        self.assertEqual(len(list(collect_garbage(3600, True))), 2)
+        self.assertEqual(save_photo(BytesIO(b'unused'), 'photo.jpg'),
+                         unused)
+        self.assertEqual(list(collect_garbage(3600)), [])
+        removed = list(collect_garbage(-1))
+        self.assertEqual(sorted(removed), sorted([
+            '.upload-left', storage_path(unused),
+            storage_path(stem + '-160.jpg')]))
+        self.assertEqual(stored_files(self.uploads), sorted([
+            used, used.replace('.jpg', '.webp')]))
+
+    def test_thumbnails(self):
+        self.app.config['APP_THUMBNAIL_SIZES'] = (160, 480, 1080)
+        self.app.config['APP_TRANSCODE_QUALITY'] = {}
+        photo = BytesIO()
+        Image.new('RGB', (800, 400), 'red').save(photo, 'BMP')
+        photo.seek(0)
+        name = save_photo(photo, 'photo.bmp')
+        made = generate_thumbnails(name).get(timeout=30)[1]
+
+        # sizes larger than the photo are not made
+        self.assertEqual(sorted(made), [thumbnail_filename(name, 160),
+                                        thumbnail_filename(name, 480)])
+        image = Image.open(os.path.join(self.uploads, storage_path(made[0])))
+        self.assertTrue(image.format == 'JPEG')
+        self.assertTrue(max(image.size) in (160, 480))
+
+        # the smallest thumbnail that is large enough is served
+        self.assertTrue(sized_photo(name) == name)
+        self.assertTrue(sized_photo(name, 100) ==
+                        thumbnail_filename(name, 160))
+        self.assertTrue(sized_photo(name, 300) ==
+                        thumbnail_filename(name, 480))
+        self.assertTrue(sized_photo(name, 1000) == name)
+        with self.app.test_request_context():
+            response = self.app.test_client().get(
+                '/photos/%s?size=160' % name)
+            self.assertTrue(Image.open(BytesIO(response.data)).size ==
+                            (160, 80))
+            post = Post(body='photo', imagefile=name)
+            thumbnails = post.to_json(['thumbnails'])['thumbnails']
+            self.assertTrue(thumbnails['480'].endswith(
+                '/photos/%s?size=480' % name))
+
+        # errors of photos that cannot be decoded are logged
+        broken = save_photo(BytesIO(b'not a photo'), 'broken.jpg')
+        errors = []
+        handler = logging.Handler()
+        handler.emit = errors.append
+        self.app.logger.addHandler(handler)
+        try:
+            result = generate_thumbnails(broken).get(timeout=30)
+        finally:
+            self.app.logger.removeHandler(handler)
+        self.assertTrue(isinstance(result[1], Exception))
+        self.assertTrue(len(errors) == 1 and
+                        broken in errors[0].getMessage())
+
+        remove_photo(name)
+        remove_photo(broken)
+        self.assertEqual(stored_files(self.uploads), [])
+
+    def test_photo_metadata(self):
+        image = Image.new('RGB', (800, 400), 'red')
+        image.paste((0, 0, 255), (0, 0, 100, 400))
+        photo = BytesIO()
+        # stored in landscape, shown in portrait
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        image.save(photo, 'JPEG', exif=exif.tobytes())
+        photo.seek(0)
+        name = save_photo(photo, 'photo.jpg')
+        post = Post(body='photo', imagefile=name)
+        db.session.add(post)
+        db.session.commit()
+        extract_metadata(name).get(timeout=30)
+
+        post = Post.query.get(post.id)
+        self.assertEqual((post.photo_width, post.photo_height),
+                         (400, 800))
+        self.assertEqual(post.photo_bytes, len(photo.getvalue()))
+        red, green, blue = [int(post.photo_color[i:i + 2], 16)
+                            for i in (1, 3, 5)]
+        self.assertTrue(red > 200 and green < 50 and blue < 50)
+        self.assertEqual(len(post.photo_blurhash), 28)
+        # uploads are hashed in the request the same way
+        columns = hash_upload(name)
+        self.assertEqual(columns['photo_dhash'], post.photo_dhash)
+        self.assertEqual(columns['photo_width'], 400)
+        self.assertEqual(post.photo_blurhash[0], 'L')
+        with self.app.test_request_context():
+            json_post = post.to_json(['img_width', 'img_color',
+                                      'img_blurhash'])
+        self.assertEqual(json_post['img_width'], 400)
+        self.assertEqual(json_post['img_blurhash'], post.photo_blurhash)
+
+    @unittest.skipIf('.webp' not in transcode_formats(),
+                     'Pillow has no WebP support')
+    def test_transcoding(self):
+        self.app.config['APP_THUMBNAIL_SIZES'] = (160,)
+        self.app.config['APP_TRANSCODE_QUALITY'] = {
+            '.webp': {None: 80, 160: 60}}
+        photo = BytesIO()
+        Image.new('RGB', (800, 400), 'red').save(photo, 'BMP')
+        photo.seek(0)
+        name = save_photo(photo, 'photo.bmp')
+        stem = os.path.splitext(name)[0]
+        made = generate_thumbnails(name).get(timeout=30)[1]
+        self.assertEqual(sorted(made), [stem + '-160.jpg',
+                                        stem + '-160.webp',
+                                        stem + '.webp'])
+
+        # clients that ask for WebP get it, others the original
+        client = self.app.test_client()
+        with self.app.test_request_context():
+            response = client.get('/photos/' + name, headers={
+                'Accept': 'image/webp,*/*'})
+            self.assertTrue(response.data.startswith(b'RIFF'))
+            self.assertTrue(b'WEBP' in response.data[:16])
+            self.assertTrue('Accept' in response.headers['Vary'])
+            self.assertTrue(len(response.data) < os.path.getsize(
+                os.path.join(self.uploads, storage_path(name))))
+            response = client.get('/photos/%s?size=100' % name,
+                                  headers={'Accept': 'image/webp'})
+            self.assertTrue(Image.open(BytesIO(response.data)).format ==
+                            'WEBP')
+            response = client.get('/photos/' + name,
+                                  headers={'Accept': '*/*'})
+            self.assertTrue(response.data.startswith(b'BM'))
+
+        remove_photo(name)
+        self.assertEqual(stored_files(self.uploads), [])
@@ -0,0 +1,51 @@
+import random
+import unittest
+from io import BytesIO
+from PIL import Image, ImageDraw
+from app.similarity import HashIndex, dhash, distance
+
+
+def make_photo(seed, size=(800, 600)):
+    random.seed(seed)
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+    for i in range(20):
+        x, y = random.randrange(size[0]), random.randrange(size[1])
+        draw.ellipse((x, y, x + random.randrange(50, 300),
+                      y + random.randrange(50, 300)),
+                     fill=tuple(random.randrange(256) for c in range(3)))
+    return image
+
+
+class SimilarityTestCase(unittest.TestCase):
+    def test_dhash(self):
+        photo = make_photo(1)
+        copy = BytesIO()
+        photo.resize((400, 300), Image.LANCZOS).save(copy, 'JPEG',
+                                                     quality=60)
+        copy.seek(0)
+        self.assertTrue(distance(dhash(photo),
+                                 dhash(Image.open(copy))) <= 4)
+        self.assertTrue(distance(dhash(photo), dhash(make_photo(2))) > 12)
+
+    def test_hash_index(self):
+        random.seed(3)
+        hashes = [random.getrandbits(64) for i in range(2000)]
+        # near duplicates of the first hashes
+        for i in range(100):
+            value = hashes[i]
+            for bit in random.sample(range(64), random.randrange(1, 10)):
+                value ^= 1 << bit
+            hashes.append(value)
+        index = HashIndex()
+        for key, value in enumerate(hashes):
+            index.add(key, value)
+        for max_distance in (0, 3, 7, 9):
+            for key in range(0, len(hashes), 50):
+                expected = sorted(
+                    other for other, value in enumerate(hashes)
+                    if distance(hashes[key], value) <= max_distance)
+                found = index.search(hashes[key], max_distance)
+                self.assertEqual(sorted(k for k, d in found), expected)
+                self.assertEqual([d for k, d in found],
+                                 sorted(d for k, d in found))
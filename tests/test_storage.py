@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from app import create_app
+from app.photos import save_photo, remove_photo, storage_path, \
+    process_photo, thumbnail_args
+from app.storage import get_storage
+from app.storage.local import LocalStorage
+from . import stored_files
+from PIL import Image
+
+try:
+    import boto3
+    from moto import mock_s3
+except ImportError:
+    mock_s3 = None
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['UPLOADS_DIR'] = tempfile.mkdtemp()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        shutil.rmtree(self.app.config['UPLOADS_DIR'])
+
+    def check_storage(self, storage):
+        storage.put('ab/cd/abcd.jpg', BytesIO(b'photo'))
+        self.assertTrue(storage.exists('ab/cd/abcd.jpg'))
+        self.assertTrue(storage.modified('ab/cd/abcd.jpg') > 0)
+        self.assertTrue(storage.touch('ab/cd/abcd.jpg'))
+        self.assertTrue(storage.get('ab/cd/abcd.jpg') == b'photo')
+        self.assertFalse(storage.touch('ab/cd/missing.jpg'))
+        self.assertTrue(storage.modified('ab/cd/missing.jpg') is None)
+        self.assertTrue(storage.get('ab/cd/abcd.jpg') == b'photo')
+        self.assertTrue(b''.join(storage.stream('ab/cd/abcd.jpg')) ==
+                        b'photo')
+        storage.delete('ab/cd/abcd.jpg')
+        storage.delete('ab/cd/abcd.jpg')
+        self.assertFalse(storage.exists('ab/cd/abcd.jpg'))
+        with self.assertRaises(IOError):
+            storage.get('ab/cd/abcd.jpg')
+        storage.put('ab/cd/abcd-160.jpg', BytesIO(b'thumbnail'))
+        storage.delete_many(['ab/cd/abcd.jpg', 'ab/cd/abcd-160.jpg'])
+        self.assertFalse(storage.exists('ab/cd/abcd-160.jpg'))
+
+    def test_local_storage(self):
+        storage = get_storage()
+        self.assertTrue(isinstance(storage, LocalStorage))
+        self.check_storage(storage)
+
+        # files of the flat layout are moved while the directory is read
+        uploads = self.app.config['UPLOADS_DIR']
+        names = ['%02x' % i * 12 + '.jpg' for i in range(50)]
+        for name in names + ['.upload-partial']:
+            with open(os.path.join(uploads, name), 'wb') as f:
+                f.write(b'photo')
+        with self.assertRaises(RuntimeError):
+            storage.iter_files()
+        for name in storage.flat_files():
+            storage.move(name, storage_path(name))
+        self.assertEqual(list(storage.flat_files()), [])
+        self.assertEqual([key for name, key, mtime in storage.iter_files()],
+                         ['.upload-partial'] +
+                         [storage_path(name) for name in names])
+        self.assertEqual(stored_files(uploads),
+                         sorted(names + ['.upload-partial']))
+        self.assertTrue(all(storage.exists(storage_path(name))
+                            for name in names))
+
+    @unittest.skipIf(mock_s3 is None, 'boto3 and moto are not installed')
+    def test_s3_storage(self):
+        self.app.config.update(
+            APP_STORAGE='s3', APP_S3_BUCKET='photos', APP_S3_PREFIX='p/',
+            APP_S3_REGION='us-east-1', APP_S3_ACCESS_KEY='key',
+            APP_S3_SECRET_KEY='secret',
+            APP_S3_MULTIPART_THRESHOLD=5 * 1024 * 1024,
+            APP_S3_MULTIPART_CHUNKSIZE=5 * 1024 * 1024,
+            APP_THUMBNAIL_SIZES=(160,), APP_TRANSCODE_QUALITY={})
+        with mock_s3():
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket='photos')
+            storage = get_storage()
+            self.check_storage(storage)
+
+            # large files are uploaded in parts
+            data = os.urandom(6 * 1024 * 1024)
+            storage.put('big', BytesIO(data))
+            self.assertTrue(storage.get('big') == data)
+            self.assertTrue(client.head_object(
+                Bucket='photos', Key='p/big')['ETag'].endswith('-2"'))
+
+            # photos are stored, processed and served from the bucket
+            photo = BytesIO()
+            Image.new('RGB', (800, 400), 'red').save(photo, 'PNG')
+            photo.seek(0)
+            with self.app.test_request_context():
+                name = save_photo(photo, 'photo.png')
+                made = process_photo(*thumbnail_args(name))
+                self.assertTrue(storage.exists(storage_path(made[0])))
+                lookups = []
+                storage.client.meta.events.register(
+                    'before-call.s3.HeadObject',
+                    lambda **kwargs: lookups.append(kwargs))
+                for i in range(3):
+                    response = self.app.test_client().get(
+                        '/photos/%s?size=160' % name)
+                # the existence of the thumbnail is looked up once
+                self.assertEqual(len(lookups), 1)
+                self.assertTrue(response.status_code == 302)
+                self.assertTrue(('/p/' + storage_path(made[0]))
+                                in response.headers['Location'])
+                self.assertTrue('Signature' in response.headers['Location'])
+                remove_photo(name)
+            self.assertFalse(storage.exists(storage_path(name)))
+            self.assertFalse(storage.exists(storage_path(made[0])))
+            self.assertEqual(os.listdir(self.app.config['UPLOADS_DIR']), [])
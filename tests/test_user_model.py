@@ -1,12 +1,15 @@
 import unittest
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from app import create_app, db
 from app.models import User, AnonymousUser, Role, Permission, Follow, Post, \
-    Comment
+    Comment, Timeline, repair_counters, role_table
+from app.cache import get_cache
+from app.presence import PresenceTracker
+from . import QueryCountMixin
 
 
-class UserModelTestCase(unittest.TestCase):
+class UserModelTestCase(QueryCountMixin, unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')
         self.app_context = self.app.app_context()
@@ -113,6 +116,48 @@ class UserModelTestCase(unittest.TestCase):
         self.assertTrue(u.can(Permission.WRITE_ARTICLES))
         self.assertFalse(u.can(Permission.MODERATE_COMMENTS))
 
+    def test_role_table(self):
+        roles = role_table()
+        self.assertTrue(roles.default.name == 'User')
+        self.assertTrue(roles.administrator.name == 'Administrator')
+        self.assertTrue([name for id, name in roles.choices] ==
+                        ['Administrator', 'Moderator', 'User'])
+
+        # users get their role and permissions without queries
+        with self.assertMaxQueries(0):
+            u = User(email='john@example.com', password='cat')
+            self.assertTrue(u.role.name == 'User')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.expunge_all()
+        u = User.query.get(user_id)
+        with self.assertMaxQueries(0):
+            self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+            self.assertFalse(u.can(Permission.MODERATE_COMMENTS))
+            self.assertTrue(role_table() is roles)
+
+        # the table is reloaded after roles change
+        r = Role(name='Editor', permissions=Permission.WRITE_ARTICLES)
+        db.session.add(r)
+        db.session.commit()
+        self.assertFalse(role_table() is roles)
+        self.assertTrue(role_table().by_name['Editor'].id == r.id)
+        u.role = Role.get_cached(r.id)
+        db.session.commit()
+        self.assertFalse(u.can(Permission.COMMENT))
+
+    def test_create_admin_without_roles(self):
+        # the administrator role may not be inserted yet
+        for role in Role.query.all():
+            db.session.delete(role)
+        db.session.commit()
+        self.assertTrue(role_table().administrator is None)
+        User.create_admin('admin@example.com', 'admin', 'cat')
+        u = User.query.filter_by(username='admin').one()
+        self.assertTrue(u.role is None)
+        self.assertFalse(u.is_administrator())
+
     def test_anonymous_user(self):
         u = AnonymousUser()
         self.assertFalse(u.can(Permission.FOLLOW))
@@ -135,6 +180,41 @@ class UserModelTestCase(unittest.TestCase):
         u.ping()
         self.assertTrue(u.last_seen > last_seen_before)
 
+    def test_presence_tracker(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        start, u2_start = u1.last_seen, u2.last_seen
+        tracker = PresenceTracker(threshold=60, flush_interval=120)
+
+        # nothing is written before the flush interval
+        tracker.seen(u1.id, start + timedelta(seconds=10))
+        tracker.seen(u2.id, start + timedelta(seconds=20))
+        db.session.expire_all()
+        self.assertTrue(u1.last_seen == start)
+
+        # nor for users whose last_seen is recent enough
+        self.assertTrue(tracker.flush(start + timedelta(seconds=20)) == 0)
+        db.session.expire_all()
+        self.assertTrue(u1.last_seen == start)
+        self.assertTrue(u2.last_seen == u2_start)
+
+        # stale ones are written in bulk once the interval elapsed
+        tracker.seen(u2.id, start + timedelta(seconds=100))
+        db.session.expire_all()
+        self.assertTrue(u2.last_seen == u2_start)
+        tracker.seen(u1.id, start + timedelta(seconds=150))
+        db.session.expire_all()
+        self.assertTrue(u1.last_seen == start + timedelta(seconds=150))
+        self.assertTrue(u2.last_seen == start + timedelta(seconds=100))
+
+        # and last_seen never goes back, e.g. with several processes
+        tracker.seen(u1.id, start + timedelta(seconds=50))
+        self.assertTrue(tracker.flush() == 0)
+        db.session.expire_all()
+        self.assertTrue(u1.last_seen == start + timedelta(seconds=150))
+
     def test_gravatar(self):
         u = User(email='john@example.com', password='cat')
         with self.app.test_request_context('/'):
@@ -189,6 +269,150 @@ class UserModelTestCase(unittest.TestCase):
         db.session.commit()
         self.assertTrue(Follow.query.count() == 1)
 
+    def test_followed_posts_timeline(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p1 = Post(body='before follow', author=u2)
+        db.session.add(p1)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [])
+
+        # following backfills the timeline, new posts are fanned out
+        u1.follow(u2)
+        db.session.commit()
+        p2 = Post(body='after follow', author=u2)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(
+            set(u1.followed_posts.all()), set([p1, p2]))
+        self.assertEqual(Timeline.query.filter_by(user_id=u1.id).count(), 2)
+
+        # deleted posts are pruned
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [p2])
+
+        # unfollowing prunes the remaining posts
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [])
+        self.assertEqual(u2.followed_posts.all(), [p2])
+
+    def test_followed_posts_fanout_on_read(self):
+        self.app.config['APP_TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # u2 now has two followers (including itself): pulled on read
+        p = Post(body='popular', author=u2)
+        db.session.add(p)
+        db.session.commit()
+        self.assertTrue(u2.fanout_on_read)
+        self.assertEqual(Timeline.query.count(), 0)
+        self.assertEqual(u1.followed_posts.all(), [p])
+        self.assertEqual(u2.followed_posts.all(), [p])
+
+        # rebuilding keeps the same view of the data
+        Timeline.rebuild()
+        self.assertEqual(u1.followed_posts.all(), [p])
+
+    def test_counters(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.org', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        p = Post(body='post', author=u2)
+        db.session.add(p)
+        db.session.add_all([Comment(body='first', author=u1, post=p),
+                            Comment(body='second', author=u1, post=p)])
+        db.session.commit()
+        self.assertEqual(p.comment_count, 2)
+        self.assertEqual((u1.post_count, u1.comment_count,
+                          u1.follower_count, u1.followed_count),
+                         (0, 2, 1, 2))
+        self.assertEqual((u2.post_count, u2.comment_count,
+                          u2.follower_count, u2.followed_count),
+                         (1, 0, 2, 1))
+
+        db.session.delete(p.comments.first())
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(p.comment_count, 1)
+        self.assertEqual(u1.comment_count, 1)
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u2.follower_count, 1)
+
+        # repair counters that went out of sync
+        u2.post_count = 42
+        p.comment_count = None
+        db.session.commit()
+        self.assertEqual(repair_counters(batch_size=1), 2)
+        self.assertEqual(u2.post_count, 1)
+        self.assertEqual(p.comment_count, 1)
+        self.assertEqual(repair_counters(), 0)
+
+    def test_token_and_identity_cache(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', role=r)
+        db.session.add(u)
+        db.session.commit()
+        token = u.generate_auth_token(3600)
+        tokens = get_cache('token')
+        identities = get_cache('identity')
+        db.session.expunge_all()
+
+        # first use verifies the token and loads the user
+        with self.assertMaxQueries(1):
+            self.assertTrue(User.verify_auth_token(token).id == u.id)
+        self.assertTrue(tokens.misses == 1 and identities.misses == 1)
+        db.session.expunge_all()
+
+        # then neither the signature nor the database are checked
+        role_table()
+        with self.assertMaxQueries(0):
+            user = User.verify_auth_token(token)
+            self.assertTrue(user.email == 'john@example.com')
+            self.assertTrue(user.can(Permission.WRITE_ARTICLES))
+        self.assertTrue(tokens.hits == 1 and identities.hits == 1)
+        self.assertFalse(User.verify_auth_token(token + 'x'))
+
+        # pings and counters do not invalidate the cached user
+        user.ping()
+        db.session.commit()
+        self.assertTrue(identities.get(u.id) is not None)
+        self.assertTrue(user.post_count == 0)
+
+        # but changes to its role, confirmation or password do
+        for change in (lambda: setattr(user, 'confirmed', True),
+                       lambda: setattr(user, 'password', 'dog'),
+                       lambda: setattr(
+                           user, 'role',
+                           Role.query.filter_by(name='Moderator').first())):
+            User.get_cached(u.id)
+            self.assertTrue(identities.get(u.id) is not None)
+            change()
+            db.session.commit()
+            self.assertTrue(identities.get(u.id) is None)
+        db.session.expunge_all()
+        user = User.get_cached(u.id)
+        db.session.expunge_all()
+        user = User.get_cached(u.id)
+        self.assertTrue(user.confirmed and user.verify_password('dog'))
+        self.assertTrue(user.can(Permission.MODERATE_COMMENTS))
+
+        # and changes to the permissions of roles apply right away
+        r = Role.query.filter_by(name='Moderator').first()
+        r.permissions = Permission.FOLLOW
+        db.session.commit()
+        self.assertFalse(user.can(Permission.MODERATE_COMMENTS))
+
     def test_user_cascade_posts(self):
         '''
         If a user is deleted, his or her posts should also be deleted